@@ -0,0 +1,308 @@
+# Import modules
+from time import sleep, time
+import threading
+import numpy as np
+
+class EmulatedAgMD2:
+    """
+    Pure-Python emulation of the part of the Keysight AgMD2 IVI-COM driver which is used by the M9203A driver.
+    It can be passed to M9203A(..., driver=EmulatedAgMD2()) to run and profile the acquisition code without hardware.
+
+    Every acquisition consists of NumRecordsPerAcquisition records which are triggered every trigger_period seconds
+    after Initiate(). In TSR mode the acquisitions are stored in the memory segments of the digitizer until Continue()
+    releases them; if all segments are full when an acquisition completes, MemoryOverflowOccurred is set.
+    The records contain a Gaussian echo on an intermediate frequency plus white noise, converted to int16 ADC codes.
+
+    Parameters:
+        trigger_period - time between two triggered records in s
+        echo_amplitude - amplitude of the echo in V
+        echo_time - time of the echo maximum after the trigger in s
+        echo_width - standard deviation of the Gaussian echo envelope in s
+        echo_frequency - intermediate frequency of the echo in Hz, Channel2 is shifted by 90 degrees
+        noise - rms noise in V
+        memory_samples - acquisition memory in samples per channel
+        call_latency - time of every driver call in s
+        configure_latency - additional time of ConfigureAcquisition in s
+        initiate_latency - time between Initiate() and the first trigger in s
+        fetch_bandwidth - transfer rate of fetched data in bytes/s
+        record_bank - number of different records per channel, acquisitions cycle through them
+        seed - seed of the random noise
+    """
+    def __init__(self, trigger_period=10e-6, echo_amplitude=0.1, echo_time=2e-6, echo_width=200e-9,
+                 echo_frequency=0.0, noise=0.02, memory_samples=64*2**20, call_latency=20e-6,
+                 configure_latency=5e-3, initiate_latency=1e-3, fetch_bandwidth=400e6, record_bank=64, seed=0):
+        self.trigger_period = trigger_period
+        self.echo_amplitude = echo_amplitude
+        self.echo_time = echo_time
+        self.echo_width = echo_width
+        self.echo_frequency = echo_frequency
+        self.noise = noise
+        self.memory_samples = memory_samples
+        self.call_latency = call_latency
+        self.configure_latency = configure_latency
+        self.initiate_latency = initiate_latency
+        self.fetch_bandwidth = fetch_bandwidth
+        self.record_bank = record_bank
+        self.seed = seed
+
+        self._lock = threading.RLock()
+        self._NumRecordsPerAcquisition = 1
+        self._RecordSize = 1024
+        self._SampleRate = 1.6e9/16
+        self._bank = None               # synthesized records of both channels, built on the first Initiate()
+        self._start_time = None         # time of the first trigger of the running acquisition, None if idle
+        self._released = 0              # number of acquisitions released by Continue()
+        self._stored = 0                # number of acquisitions which completed and found a free memory segment
+        self._overflow = False
+        self._initiations = 0
+
+        self.Channels = _Channels(self)
+        self.Acquisition = _Acquisition(self)
+        self.Acquisition3 = _Acquisition3(self)
+        self.Trigger = _Trigger()
+        self.Calibration = _Calibration(self)
+        self.calls = 0                  # number of emulated driver calls
+
+    def _call(self, duration=0.0):
+        # emulates the latency of a driver call
+        self.calls += 1
+        sleep(self.call_latency + duration)
+
+    def Initialize(self, ResourceName, IdQuery, Reset, OptionString):
+        self._call()
+
+    def close(self):
+        self._call()
+        self._start_time = None
+
+    def _configure(self, NumRecordsPerAcquisition, RecordSize, SampleRate):
+        with self._lock:
+            if self._start_time is not None:
+                raise RuntimeError('ConfigureAcquisition is not allowed while an acquisition is running')
+            self._NumRecordsPerAcquisition = int(NumRecordsPerAcquisition)
+            self._RecordSize = int(RecordSize)
+            self._SampleRate = SampleRate
+            self._bank = None
+        self._call(self.configure_latency)
+
+    def _synthesize(self):
+        # builds record_bank records of both channels in volts, they are converted to codes by the channel range
+        rng = np.random.default_rng(self.seed)
+        t = np.arange(self._RecordSize)/self._SampleRate
+        envelope = self.echo_amplitude*np.exp(-0.5*((t - self.echo_time)/self.echo_width)**2)
+        phase = 2*np.pi*self.echo_frequency*t
+        echo = (envelope*np.cos(phase), envelope*np.sin(phase))
+        nbank = max(1, min(self.record_bank, self._NumRecordsPerAcquisition*4))
+        self._bank = {}
+        for name, signal in zip(('Channel1', 'Channel2'), echo):
+            channel = self.Channels(name)
+            volts = signal + self.noise*rng.standard_normal((nbank, self._RecordSize))
+            codes = np.round((volts - channel.Offset)/channel.ScaleFactor)
+            self._bank[name] = np.clip(codes, -32768, 32767).astype(np.int16)
+
+    def _initiate(self):
+        self._call()
+        with self._lock:
+            if self._bank is None:
+                self._synthesize()
+            self._start_time = time() + self.initiate_latency
+            self._released = 0
+            self._stored = 0
+            self._overflow = False
+            self._initiations += 1
+            for channel in self.Channels.channels.values():
+                channel.Measurement.next_record = 0
+
+    def _abort(self):
+        self._call()
+        with self._lock:
+            self._start_time = None
+
+    def _segments(self):
+        # number of acquisitions which fit into the memory
+        return max(1, self.memory_samples//(self._NumRecordsPerAcquisition*self._RecordSize))
+
+    def _update(self):
+        # stores the acquisitions which completed since the last update
+        if self._start_time is None:
+            return
+        completed = int((time() - self._start_time)/(self._NumRecordsPerAcquisition*self.trigger_period))
+        if not self.Acquisition3.TSR.Enabled:
+            completed = min(completed, 1)
+        if completed > self._stored:
+            free = self._released + self._segments() - self._stored
+            if completed - self._stored > free:
+                self._overflow = True
+            self._stored += min(completed - self._stored, free)
+
+    def _is_complete(self):
+        self._call()
+        with self._lock:
+            self._update()
+            return 1 if self._stored > self._released else 0
+
+    def _memory_overflow(self):
+        self._call()
+        with self._lock:
+            self._update()
+            return 1 if self._overflow else 0
+
+    def _continue(self):
+        self._call()
+        with self._lock:
+            self._update()
+            if self._stored <= self._released:
+                raise RuntimeError('TSR Continue without a completed acquisition')
+            self._released += 1
+            for channel in self.Channels.channels.values():
+                channel.Measurement.next_record = 0
+
+    def _wait(self, MaxTimeMilliseconds):
+        with self._lock:
+            if self._start_time is None:
+                raise RuntimeError('No acquisition was initiated')
+            remaining = self._start_time + self._NumRecordsPerAcquisition*self.trigger_period - time()
+        if remaining > MaxTimeMilliseconds/1000:
+            sleep(MaxTimeMilliseconds/1000)
+            raise RuntimeError('Timeout of WaitForAcquisitionComplete')
+        self._call(max(remaining, 0.0))
+
+    def _records(self, name, first, num):
+        # returns the records of the oldest stored acquisition
+        with self._lock:
+            self._update()
+            if self._stored <= self._released:
+                raise RuntimeError('No completed acquisition to fetch')
+            acquisition = self._released + self._initiations - 1
+        nbank = self._bank[name].shape[0]
+        index = (acquisition*self._NumRecordsPerAcquisition + first + np.arange(num)) % nbank
+        return self._bank[name][index]
+
+class _Channels:
+    def __init__(self, driver):
+        self.channels = {name: _Channel(driver, name) for name in ('Channel1', 'Channel2')}
+
+    def __call__(self, name):
+        return self.channels[name]
+
+class _Channel:
+    def __init__(self, driver, name):
+        self._driver = driver
+        self._Offset = 0.0
+        self._Range = 1.0
+        self.Measurement = _Measurement(driver, name)
+        self.MultiRecordMeasurement = _MultiRecordMeasurement(driver, name)
+
+    # the records are synthesized again with the new ADC scaling
+    @property
+    def Offset(self):
+        return self._Offset
+
+    @Offset.setter
+    def Offset(self, value):
+        self._Offset = value
+        self._driver._bank = None
+
+    @property
+    def Range(self):
+        return self._Range
+
+    @Range.setter
+    def Range(self, value):
+        self._Range = value
+        self._driver._bank = None
+
+    @property
+    def ScaleFactor(self):
+        return self.Range/2**16
+
+class _Measurement:
+    def __init__(self, driver, name):
+        self._driver = driver
+        self._name = name
+        self.next_record = 0
+
+    def FetchWaveformInt16(self):
+        driver = self._driver
+        record = driver._records(self._name, self.next_record, 1)[0]
+        self.next_record += 1
+        driver._call(record.nbytes/driver.fetch_bandwidth)
+        channel = driver.Channels(self._name)
+        return [record, len(record), 0, 0.0, 0.0, 0.0, 1/driver._SampleRate, channel.ScaleFactor, channel.Offset]
+
+class _MultiRecordMeasurement:
+    def __init__(self, driver, name):
+        self._driver = driver
+        self._name = name
+
+    def FetchMultiRecordWaveformInt16(self, FirstRecord, NumRecords, OffsetWithinRecord, NumPointsPerRecord):
+        driver = self._driver
+        records = driver._records(self._name, FirstRecord, NumRecords)[:, OffsetWithinRecord:OffsetWithinRecord+NumPointsPerRecord]
+        npts = records.shape[1]
+        stride = -(-npts//32)*32 + 32      # the driver pads every record in its output array
+        OutArray = np.zeros(NumRecords*stride, dtype=np.int16)
+        FirstValidPoint = np.arange(NumRecords)*stride + 16
+        OutArray.reshape(NumRecords, stride)[:, 16:16+npts] = records
+        driver._call(OutArray.nbytes/driver.fetch_bandwidth)
+        channel = driver.Channels(self._name)
+        zeros = np.zeros(NumRecords)
+        return [OutArray, NumRecords, np.full(NumRecords, npts), FirstValidPoint, zeros, zeros, zeros,
+                1/driver._SampleRate, channel.ScaleFactor, channel.Offset]
+
+class _Acquisition:
+    def __init__(self, driver):
+        self._driver = driver
+
+    def WaitForAcquisitionComplete(self, MaxTimeMilliseconds):
+        self._driver._wait(MaxTimeMilliseconds)
+
+class _Acquisition3:
+    def __init__(self, driver):
+        self._driver = driver
+        self.TSR = _TSR(driver)
+
+    def ConfigureAcquisition(self, NumRecordsPerAcquisition, RecordSize, SampleRate):
+        self._driver._configure(NumRecordsPerAcquisition, RecordSize, SampleRate)
+
+    def Initiate(self):
+        self._driver._initiate()
+
+    def abort(self):
+        self._driver._abort()
+
+class _TSR:
+    def __init__(self, driver):
+        self._driver = driver
+        self.Enabled = 0
+
+    @property
+    def IsAcquisitionComplete(self):
+        return self._driver._is_complete()
+
+    @property
+    def MemoryOverflowOccurred(self):
+        return self._driver._memory_overflow()
+
+    def Continue(self):
+        self._driver._continue()
+
+class _TriggerSource:
+    def __init__(self):
+        self.Level = 0.0
+
+class _TriggerSources(dict):
+    def __missing__(self, name):
+        self[name] = _TriggerSource()
+        return self[name]
+
+class _Trigger:
+    def __init__(self):
+        self.ActiveSource = 'External1'
+        self.Sources = _TriggerSources()
+
+class _Calibration:
+    def __init__(self, driver):
+        self._driver = driver
+
+    def SelfCalibrate(self):
+        self._driver._call(1.0)
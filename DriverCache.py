@@ -0,0 +1,57 @@
+from qcodes import (validators as vals)
+
+class DriverValueCache:
+    """
+    Mixin for instruments which serves repeated gets of driver settings from a cache, so e.g. snapshots
+    do not cost a driver round trip per setting. Getters and setters of the instrument and its channels call
+    cached_get and cached_set with a key such as (channel, attribute) and a function which calls the driver.
+    A set drops the cached value instead of storing the requested one, because the driver may coerce it
+    (e.g. round a sample rate), so the next get reads the value the hardware actually has.
+    The cache is off by default; the instrument calls init_driver_cache() in its __init__ to add the
+    DriverCache and DriverRoundTrips parameters.
+    """
+    def init_driver_cache(self):
+        self._DriverCache = False       # serve gets from the last value read instead of calling the driver
+        self._driver_values = {}        # key -> last value read from the driver
+        self._DriverRoundTrips = 0      # number of driver calls made by cached getters and setters
+
+        self.add_parameter(name='DriverCache',
+                           label='Serve gets from the driver value cache',
+                           set_cmd=self.set_DriverCache,
+                           get_cmd=self.get_DriverCache,
+                           vals = vals.Bool())
+
+        self.add_parameter(name='DriverRoundTrips',
+                           label='Number of driver calls of cached getters and setters',
+                           get_cmd=self.get_DriverRoundTrips,
+                           set_cmd=False)
+
+    def set_DriverCache(self,value):
+        self._DriverCache = value
+        self._driver_values.clear()
+
+    def get_DriverCache(self):
+        return self._DriverCache
+
+    def get_DriverRoundTrips(self):
+        return self._DriverRoundTrips
+
+    def cached_get(self, key, function):
+        # returns the cached value of key, or calls the driver function and caches its result if the cache is enabled
+        if self._DriverCache and key in self._driver_values:
+            return self._driver_values[key]
+        self._DriverRoundTrips += 1
+        value = function()
+        if self._DriverCache:
+            self._driver_values[key] = value
+        return value
+
+    def cached_set(self, key, function):
+        # calls the driver function which writes the value of key and drops its cached value
+        self._driver_values.pop(key, None)
+        self._DriverRoundTrips += 1
+        function()
+
+    def resync_driver_cache(self):
+        """ drops all cached values, so the next get of every parameter reads the driver again """
+        self._driver_values.clear()
@@ -0,0 +1,203 @@
+# Import modules
+from time import sleep
+import numpy as np
+
+class EmulatedKtMAwg:
+    """
+    Pure-Python emulation of the part of the KtMAwgWrapper driver which is used by the M9336A driver.
+    It can be passed to M9336A(..., driver=EmulatedKtMAwg()) to run and profile the AWG code without hardware.
+
+    Waveforms are kept in an emulated AWG memory; CreateChannelWaveform fails if they do not fit, Clear frees them.
+    A channel has to be configured with a waveform before its generation can be initiated,
+    and it can only be configured while it is not generating.
+
+    Parameters:
+        memory_bytes - AWG waveform memory in bytes
+        bytes_per_sample - memory used by one sample including its marker byte
+        call_latency - time of every driver call in s
+        upload_bandwidth - transfer rate of uploaded waveform and marker arrays in bytes/s
+        configure_latency - additional time of Arbitrary.Configure in s
+        initiate_latency - additional time of InitiateGeneration in s
+    """
+    def __init__(self, memory_bytes=2*2**30, bytes_per_sample=3, call_latency=20e-6, upload_bandwidth=200e6,
+                 configure_latency=1e-3, initiate_latency=1e-3):
+        self.memory_bytes = memory_bytes
+        self.bytes_per_sample = bytes_per_sample
+        self.call_latency = call_latency
+        self.upload_bandwidth = upload_bandwidth
+        self.configure_latency = configure_latency
+        self.initiate_latency = initiate_latency
+
+        self.waveforms = {}             # handle -> (channel, name, waveform, markers)
+        self.memory_used = 0            # bytes used by the waveforms
+        self.configured = {}            # channel -> handle of the configured waveform
+        self.generating = set()         # channels in the Output Generation State
+        self.settings = {}              # (channel, setting) -> value
+        self._next_handle = 1
+
+        self.Arbitrary = _Arbitrary(self)
+        self.Output = _Output(self)
+        self.Trigger = _Trigger(self)
+        self.Markers = _Markers(self)
+        self.calls = 0                  # number of emulated driver calls
+
+    def _call(self, duration=0.0):
+        # emulates the latency of a driver call
+        self.calls += 1
+        sleep(self.call_latency + duration)
+
+    def _get(self, channel, setting, default):
+        self._call()
+        return self.settings.get((channel, setting), default)
+
+    def _set(self, channel, setting, value):
+        self._call()
+        self.settings[(channel, setting)] = value
+
+    def Initialize(self, ResourceName, OptionString):
+        self._call()
+
+    def Close(self):
+        self._call()
+        self.generating.clear()
+
+    def GetOperationMode(self, channel):
+        return self._get(channel, 'OperationMode', 0)
+
+    def SetOperationMode(self, channel, value):
+        self._set(channel, 'OperationMode', value)
+
+    def InitiateGeneration(self, channels):
+        self._call(self.initiate_latency)
+        for channel in channels.split(','):
+            if channel not in self.configured:
+                raise RuntimeError('{0} has no configured waveform'.format(channel))
+        self.generating.update(channels.split(','))
+
+    def AbortGeneration(self, channels):
+        self._call()
+        self.generating.difference_update(channels.split(','))
+
+class _Waveform:
+    def __init__(self, driver):
+        self._driver = driver
+
+    def CreateChannelWaveform(self, channel, name, waveform, markers):
+        driver = self._driver
+        waveform = np.asarray(waveform, dtype=np.float64)
+        markers = np.asarray(markers)
+        driver._call((waveform.nbytes + markers.nbytes)/driver.upload_bandwidth)
+        size = driver.bytes_per_sample*len(waveform)
+        if driver.memory_used + size > driver.memory_bytes:
+            raise MemoryError('Not enough AWG memory for a waveform of {0} samples'.format(len(waveform)))
+        if len(markers) not in (0, len(waveform)):
+            raise ValueError('The marker array must be empty or as long as the waveform')
+        handle = driver._next_handle
+        driver._next_handle += 1
+        driver.waveforms[handle] = (channel, name, waveform, markers)
+        driver.memory_used += size
+        return [handle]
+
+    def Clear(self, handle):
+        driver = self._driver
+        driver._call()
+        if handle in driver.configured.values():
+            raise RuntimeError('Waveform {0} is configured and cannot be cleared'.format(handle))
+        channel, name, waveform, markers = driver.waveforms.pop(handle)
+        driver.memory_used -= driver.bytes_per_sample*len(waveform)
+
+class _Arbitrary:
+    def __init__(self, driver):
+        self._driver = driver
+        self.Waveform = _Waveform(driver)
+
+    def GetSampleRate(self, channel):
+        return self._driver._get(channel, 'SampleRate', 1.28e9)
+
+    def SetSampleRate(self, channel, value):
+        self._driver._set(channel, 'SampleRate', value)
+
+    def GetGain(self, channel):
+        return self._driver._get(channel, 'Gain', 0.4)
+
+    def SetGain(self, channel, value):
+        self._driver._set(channel, 'Gain', value)
+
+    def GetOffset(self, channel):
+        return self._driver._get(channel, 'Offset', 0.0)
+
+    def SetOffset(self, channel, value):
+        self._driver._set(channel, 'Offset', value)
+
+    def GetCommonModeOffset(self, channel):
+        return self._driver._get(channel, 'CommonModeOffset', 0.0)
+
+    def SetCommonModeOffset(self, channel, value):
+        self._driver._set(channel, 'CommonModeOffset', value)
+
+    def Configure(self, channel, handle, gain, offset, common_mode_offset):
+        driver = self._driver
+        driver._call(driver.configure_latency)
+        if channel in driver.generating:
+            raise RuntimeError('{0} cannot be configured while it is generating'.format(channel))
+        if handle not in driver.waveforms:
+            raise ValueError('Unknown waveform handle {0}'.format(handle))
+        driver.configured[channel] = handle
+        driver.settings[(channel, 'Gain')] = gain
+        driver.settings[(channel, 'Offset')] = offset
+        driver.settings[(channel, 'CommonModeOffset')] = common_mode_offset
+
+class _Output:
+    def __init__(self, driver):
+        self._driver = driver
+
+    def GetChannelMode(self, channel):
+        return self._driver._get(channel, 'ChannelMode', 0)
+
+    def SetChannelMode(self, channel, value):
+        self._driver._set(channel, 'ChannelMode', value)
+
+    def GetTerminalConfiguration(self, channel):
+        return self._driver._get(channel, 'TerminalConfiguration', 0)
+
+    def SetTerminalConfiguration(self, channel, value):
+        self._driver._set(channel, 'TerminalConfiguration', value)
+
+    def SetEnabled(self, channel, value):
+        self._driver._set(channel, 'Enabled', value)
+
+class _Start:
+    def __init__(self, driver):
+        self._driver = driver
+
+    def GetBurstCount(self, channel):
+        return self._driver._get(channel, 'BurstCount', 1)
+
+    def SetBurstCount(self, channel, value):
+        self._driver._set(channel, 'BurstCount', value)
+
+class _Trigger:
+    def __init__(self, driver):
+        self.Start = _Start(driver)
+
+class _Marker:
+    def __init__(self, driver, name):
+        self._driver = driver
+        self.name = name
+        self.configuration = {}         # channel -> (bit position, destination)
+
+    def Configure(self, channel, bit, destination):
+        self._driver._call()
+        self.configuration[channel] = (bit, destination)
+
+class _Markers:
+    def __init__(self, driver):
+        self._driver = driver
+        self._markers = {}
+
+    def Add(self, name):
+        self._driver._call()
+        self._markers[name] = _Marker(self._driver, name)
+
+    def Item(self, name):
+        return self._markers[name]
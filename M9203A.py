@@ -1,13 +1,668 @@
 # Import modules
-from time import sleep, time
+from time import sleep, time, perf_counter
+import abc
+import bisect
+import logging
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import numpy as np
 
-import comtypes.client # driver for IVI-COM
-
 BIGINT = int(1e18)
+MAX_SAMPLES_PER_CHANNEL = 64*2**20      # acquisition memory of the M9203A-M02 option, 64M samples per channel
+MAX_SAMPLE_RATE = 1.6e9
 
 from qcodes import (Instrument, MultiParameter, ManualParameter, validators as vals)
 from qcodes.instrument.channel import InstrumentChannel
+from qcodes.instrument_drivers.Keysight.DriverCache import DriverValueCache
+
+log = logging.getLogger(__name__)
+
+def log_acquisition(name, nacqs, nrcds, elapsed_time, nrecords):
+    # one structured log entry per get() of an acquisition parameter instead of printing
+    log.info('get() of "%s": %d acquisitions x %d records in %.6f s (%.0f records/s)', name, nacqs, nrcds, elapsed_time, nrecords/max(elapsed_time,1e-9),
+             extra={'acquisition': {'parameter': name, 'nacqs': nacqs, 'nrcds': nrcds, 'elapsed_time': elapsed_time, 'records': nrecords}})
+
+def _com_thread_in_mta():
+    # True if COM of the calling thread is initialized as multithreaded apartment
+    import ctypes
+    APTTYPE_MTA = 1
+    AptType, AptQualifier = ctypes.c_int(), ctypes.c_int()
+    try:
+        ctypes.oledll.ole32.CoGetApartmentType(ctypes.byref(AptType), ctypes.byref(AptQualifier))
+    except OSError:     # COM is not initialized in this thread
+        return False
+    return AptType.value == APTTYPE_MTA
+
+class StageTimer:
+    """
+    Low-overhead timing of the stages of an acquisition (arm, wait, fetch, scale, accumulate, continue, abort).
+    For every stage the number of calls, the total, minimum and maximum time and a histogram with
+    logarithmic bins (5 per decade from 100 ns to 100 s, plus under- and overflow bin) are recorded.
+    A stage which is entered again while it is already open (e.g. arm of the digitizer inside arm of Zoidberg2)
+    is only timed once.
+    Example:
+        with timer.stage('fetch'):
+            ...
+    """
+    STAGES = ('arm', 'wait', 'fetch', 'scale', 'accumulate', 'continue', 'abort')
+    BIN_EDGES = [10**(k/5) for k in range(-35, 11)]
+    
+    def __init__(self):
+        self._open = set()      # stages which are currently timed
+        self.reset()
+    
+    def reset(self):
+        self._stats = {stage: [0, 0.0, float('inf'), 0.0, [0]*(len(self.BIN_EDGES)+1)] for stage in self.STAGES}   # count, total, min, max, histogram
+    
+    def add(self, stage, duration):
+        stats = self._stats[stage]
+        stats[0] += 1
+        stats[1] += duration
+        if duration < stats[2]:
+            stats[2] = duration
+        if duration > stats[3]:
+            stats[3] = duration
+        stats[4][bisect.bisect(self.BIN_EDGES, duration)] += 1
+    
+    def stage(self, stage):
+        return _TimedStage(self, stage)
+    
+    def statistics(self):
+        """ returns {stage: {count, total_time, mean_time, min_time, max_time, histogram}} and the bin edges in s """
+        statistics = {'bin_edges': list(self.BIN_EDGES)}
+        for stage, (count, total, minimum, maximum, histogram) in self._stats.items():
+            statistics[stage] = {'count': count,
+                                 'total_time': total,
+                                 'mean_time': total/count if count else None,
+                                 'min_time': minimum if count else None,
+                                 'max_time': maximum if count else None,
+                                 'histogram': list(histogram)}
+        return statistics
+
+class _TimedStage:
+    __slots__ = ('_timer', '_stage', '_start')
+    
+    def __init__(self, timer, stage):
+        self._timer = timer
+        self._stage = stage
+        self._start = None
+    
+    def __enter__(self):
+        if self._stage not in self._timer._open:
+            self._timer._open.add(self._stage)
+            self._start = perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        if self._start is not None:
+            self._timer.add(self._stage, perf_counter() - self._start)
+            self._timer._open.discard(self._stage)
+        return False
+
+class RecordAverager:
+    """
+    Streaming averager for the records of both digitizer channels.
+    The raw int16 ADC codes are summed in place into preallocated int64 accumulators,
+    ScaleFactor and ScaleOffset are applied only once when the average is read.
+    With a phase cycle, record r of every acquisition is weighted with PhaseCycle[r % len(PhaseCycle)],
+    a sign or a complex receiver phase which rotates (I,Q) = (Channel1,Channel2). The codes are summed
+    separately for every position in the cycle and the weights are applied only once when the average is read.
+    Parameters:
+        npts - number of points per record
+        PhaseCycle - sequence of signs or complex phases, None for equal weights
+        timer - StageTimer which records the accumulate and scale stages
+    """
+    def __init__(self, npts, PhaseCycle=None, timer=None):
+        self.timer = StageTimer() if timer is None else timer
+        self.PhaseCycle = None if PhaseCycle is None else np.asarray(PhaseCycle, dtype=np.complex128)
+        ncycle = 1 if self.PhaseCycle is None else len(self.PhaseCycle)
+        self.Sum1 = np.zeros((ncycle, npts), dtype=np.int64)
+        self.Sum2 = np.zeros((ncycle, npts), dtype=np.int64)
+        self.Counts = np.zeros((ncycle,), dtype=np.int64)    # number of records summed at every position in the cycle
+        self.NumRecords = 0
+        self.Scale1 = (0.0, 0.0)    # (ScaleFactor, ScaleOffset) of Channel1
+        self.Scale2 = (0.0, 0.0)    # (ScaleFactor, ScaleOffset) of Channel2
+        self._partial = np.empty((ncycle, npts), dtype=np.int64)    # buffer for the sum over the records of one acquisition
+        self._scaled = np.empty((npts,))    # buffer for the scaled sums of one cycle position in average()
+    
+    def add(self, Codes1, Codes2, ScaleFactor1, ScaleOffset1, ScaleFactor2, ScaleOffset2):
+        """ adds all records of one acquisition, i.e. int16 arrays of shape (nrcds, npts) """
+        with self.timer.stage('accumulate'):
+            self._add(Codes1, Codes2)
+        self.Scale1 = (ScaleFactor1, ScaleOffset1)
+        self.Scale2 = (ScaleFactor2, ScaleOffset2)
+    
+    def _add(self, Codes1, Codes2):
+        nrcds, npts = Codes1.shape
+        ncycle = self.Sum1.shape[0]
+        for Codes, Sum in ((Codes1, self.Sum1), (Codes2, self.Sum2)):
+            if nrcds % ncycle == 0:
+                # one pass over all records, the cycle positions are a view on the acquisition
+                np.sum(Codes.reshape(nrcds//ncycle, ncycle, npts), axis=0, dtype=np.int64, out=self._partial)
+            else:
+                for k in range(ncycle):
+                    np.sum(Codes[k::ncycle], axis=0, dtype=np.int64, out=self._partial[k])
+            Sum += self._partial
+        self.Counts += (nrcds - np.arange(ncycle) + ncycle - 1)//ncycle
+        self.NumRecords += nrcds
+    
+    def average(self, out=None):
+        """
+        returns the averaged records of both channels in volts
+        Parameters:
+            out - optional float64 array of shape (2, npts) into which the averages are written
+        """
+        with self.timer.stage('scale'):
+            return self._average(out)
+    
+    def _average(self, out=None):
+        n = max(self.NumRecords, 1)
+        if out is None:
+            out = np.empty((2, self.Sum1.shape[1]))
+        if self.PhaseCycle is None:
+            np.multiply(self.Sum1[0], self.Scale1[0]/n, out=out[0])
+            np.multiply(self.Sum2[0], self.Scale2[0]/n, out=out[1])
+            if self.NumRecords > 0:
+                out[0] += self.Scale1[1]
+                out[1] += self.Scale2[1]
+            return out[0], out[1]
+        # I + iQ = sum over the cycle positions k of phase[k]*(V1[k] + iV2[k]) with the summed voltages
+        # V[k] = Sum[k]*ScaleFactor + Counts[k]*ScaleOffset, accumulated in out without temporary arrays
+        out.fill(0.0)
+        for k, phase in enumerate(self.PhaseCycle/n):
+            for Sum, (ScaleFactor, ScaleOffset), WeightI, WeightQ in ((self.Sum1[k], self.Scale1, phase.real, phase.imag),
+                                                                       (self.Sum2[k], self.Scale2, -phase.imag, phase.real)):
+                for Out, Weight in ((out[0], WeightI), (out[1], WeightQ)):
+                    if Weight == 0:
+                        continue
+                    np.multiply(Sum, Weight*ScaleFactor, out=self._scaled)
+                    Out += self._scaled
+                    Out += Weight*self.Counts[k]*ScaleOffset
+        return out[0], out[1]
+
+class AcquisitionBlock:
+    """
+    Records of one acquisition of both digitizer channels in raw ADC units.
+    Parameters:
+        Codes1, Codes2 - int16 arrays of shape (nrcds, npts) into which the records are fetched
+    """
+    def __init__(self, Codes1, Codes2):
+        self.index = -1         # index of the acquisition
+        self.Codes1 = Codes1
+        self.Codes2 = Codes2
+        self.ScaleFactor1 = self.ScaleOffset1 = self.InitialXOffset1 = self.XIncrement1 = 0.0
+        self.ScaleFactor2 = self.ScaleOffset2 = self.InitialXOffset2 = self.XIncrement2 = 0.0
+    
+    def time(self):
+        """ returns the time arrays of both channels """
+        npts = self.Codes1.shape[1]
+        Time1 = np.linspace(self.InitialXOffset1,self.InitialXOffset1+npts*self.XIncrement1,npts)
+        Time2 = np.linspace(self.InitialXOffset2,self.InitialXOffset2+npts*self.XIncrement2,npts)
+        return Time1, Time2
+
+class AcquisitionPipeline:
+    """
+    Iterates over the acquisitions of a started digitizer and yields an AcquisitionBlock for each of them.
+    Each acquisition is waited for, fetched and released with continue_acquisition() before it is handed
+    to the consumer, so the digitizer memory is freed as early as possible.
+    If threaded, a fetch thread does this in the background and passes the blocks through a bounded queue,
+    so the digitizer is drained while the consumer is still processing the previous block. A block must not be
+    used after the next one has been requested, because its buffers are reused.
+    Use as a context manager, so the fetch thread is always stopped:
+        with dig.acquisitions(nacqs, nrcds, npts) as pipeline:
+            for block in pipeline:
+                ...
+        if pipeline.completed: ...
+    Parameters:
+        digitizer - M9203A instance
+        nacqs - number of acquisitions
+        nrcds - number of records per one acquisition
+        npts - number of points
+        threaded - fetch in a background thread
+        out - optional pair of int16 arrays of shape (nacqs*nrcds, npts), records are then fetched straight into them
+        depth - number of buffers in flight between the fetch thread and the consumer (2 = double buffering)
+        stop_event - optional threading.Event which ends the acquisitions once set, a wait for an acquisition
+                     then returns at once. It is only read, close() stops the pipeline with an event of its own.
+    """
+    _END = object()     # marks the end of the fetched blocks in the queue
+    
+    def __init__(self, digitizer, nacqs, nrcds, npts, threaded=False, out=None, depth=2, stop_event=None):
+        self._digitizer = digitizer
+        self.nacqs = nacqs
+        self.nrcds = nrcds
+        self.npts = npts
+        self.threaded = threaded
+        self.completed = False      # True once all acquisitions were fetched without error
+        self.NumFetchedRecords = 0
+        self._out = out
+        
+        # buffers that can be filled by the fetch thread
+        self._free = queue.Queue()
+        for _ in range(depth):
+            self._free.put(self._new_block(0))
+        self._filled = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()      # set by close(), no further acquisitions are fetched
+        self._stop_events = (self._stop,) if stop_event is None else (self._stop, stop_event)
+        self._closed = threading.Event()    # the consumer does not read the queue anymore
+        self._thread = None
+    
+    def _new_block(self, i):
+        if self._out is not None:
+            rows = slice(i*self.nrcds, (i+1)*self.nrcds)
+            return AcquisitionBlock(self._out[0][rows], self._out[1][rows])
+        return AcquisitionBlock(np.empty((self.nrcds,self.npts), dtype=np.int16), np.empty((self.nrcds,self.npts), dtype=np.int16))
+    
+    def _fetch(self, Block, i):
+        """ waits for acquisition i and fetches it into Block, returns None if the acquisition failed """
+        if self._out is not None:
+            Block = self._new_block(i)
+        timer = self._digitizer.timer
+        with timer.stage('wait'):
+            if self._digitizer.WaitUntilAcqComplete(*self._stop_events) == False:     # Indicates if a (single- or multi-record) waveform can be fetched from the instrument.
+                return None
+        Block.index = i
+        self._digitizer.fetch_acquisition(Block)
+        self.NumFetchedRecords += self.nrcds
+        return Block
+    
+    def _stopped(self):
+        return any(stop_event.is_set() for stop_event in self._stop_events)
+    
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._filled.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+    
+    def _producer(self):
+        try:
+            self._digitizer.init_fetch_thread()
+            for i in range(self.nacqs):
+                Block = None
+                while Block is None and not self._stopped():
+                    try:
+                        Block = self._free.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                if self._stopped():
+                    break
+                Block = self._fetch(Block, i)
+                if Block is None:
+                    break
+                self._put(Block)
+            else:
+                self.completed = True
+            self._put(self._END)
+        except Exception as error:
+            self._put(error)
+        finally:
+            self._digitizer.exit_fetch_thread()
+    
+    def __enter__(self):
+        if self.threaded:
+            self._thread = threading.Thread(target=self._producer, name='{0}_fetch'.format(self._digitizer.name), daemon=True)
+            self._thread.start()
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def close(self):
+        """ stops the fetch thread, a wait for the next acquisition returns without waiting for the timeout """
+        self._stop.set()
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def __iter__(self):
+        if not self.threaded:
+            Block = self._free.get()
+            for i in range(self.nacqs):
+                Block = self._fetch(Block, i)
+                if Block is None:
+                    return
+                yield Block
+            self.completed = True
+            return
+        
+        while True:
+            item = self._filled.get()
+            if item is self._END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            self._free.put(item)
+
+class Reducer(abc.ABC):
+    """
+    Base class of the reducers which M9203A.measure() feeds with the fetched acquisitions.
+    prepare() is called before the digitizer is armed, so a bad setting fails early, add() with every
+    AcquisitionBlock and result() once at the end with the last block (None if the acquisition failed).
+    close() is always called after the measurement to release resources such as worker threads.
+    A reducer may set out to a pair of int16 arrays of shape (nacqs*nrcds, npts) in prepare(), the records are then
+    fetched straight into them. Only one reducer of a measurement can do this.
+    """
+    out = None
+    stop_requested = False      # set by a reducer to end the measurement after the current acquisition
+    
+    def prepare(self, digitizer, nacqs, nrcds, npts):
+        self.timer = digitizer.timer
+    
+    @abc.abstractmethod
+    def add(self, Block):
+        pass
+    
+    @abc.abstractmethod
+    def result(self, Block):
+        pass
+    
+    def close(self):
+        pass
+
+class MeanTrace(Reducer):
+    """
+    Averages the records of both channels over all records and acquisitions (with the PhaseCycle of the digitizer).
+    Every publish_every acquisitions the average so far is written into the buffer PartialAverage of shape (2, npts),
+    which is the same array during the whole measurement, and published to the digitizer (PartialAverage and
+    PartialAverageCount) and to callback(PartialAverage, number of acquisitions). If the callback returns True,
+    the measurement stops after the current acquisition and returns the average of the acquisitions so far.
+    The buffer is overwritten at the next publication, so a callback which keeps it has to copy it.
+    Result: (I, Q, TimeI, TimeQ) in V and s
+    Parameters:
+        publish_every - number of acquisitions between two publications, 0 for none, None for PublishInterval of the digitizer
+        callback - function(PartialAverage, number of acquisitions), None for PublishCallback of the digitizer
+    """
+    def __init__(self, publish_every=None, callback=None):
+        self.publish_every = publish_every
+        self.callback = callback
+    
+    def prepare(self, digitizer, nacqs, nrcds, npts):
+        super().prepare(digitizer, nacqs, nrcds, npts)
+        self.npts = npts
+        self.nacqs = nacqs
+        self.Averager = digitizer.averager(npts)    # sums the ADC codes over all records and acquisitions
+        self._average = None
+        self._digitizer = digitizer
+        self._publish_every = digitizer.PublishInterval() if self.publish_every is None else self.publish_every
+        self._callback = digitizer.PublishCallback() if self.callback is None else self.callback
+        self.NumAcquisitions = 0
+        self.stop_requested = False
+        self.PartialAverage = np.zeros((2, npts)) if self._publish_every else None
+    
+    def add(self, Block):
+        self.Averager.add(Block.Codes1, Block.Codes2, Block.ScaleFactor1, Block.ScaleOffset1, Block.ScaleFactor2, Block.ScaleOffset2)
+        self.NumAcquisitions += 1
+        if self._publish_every and self.NumAcquisitions % self._publish_every == 0 and self.NumAcquisitions < self.nacqs:
+            self.publish()
+    
+    def publish(self):
+        """ writes the average so far into PartialAverage and passes it on """
+        self.Averager.average(out=self.PartialAverage)
+        self._digitizer.PartialAverage = self.PartialAverage
+        self._digitizer.PartialAverageCount = self.NumAcquisitions
+        if self._callback is not None and self._callback(self.PartialAverage, self.NumAcquisitions) is True:
+            log.info('Averaging stopped by the callback after %d of %d acquisitions', self.NumAcquisitions, self.nacqs)
+            self.stop_requested = True
+    
+    def average(self):
+        """ returns the averaged records of both channels in volts """
+        if self._average is None:
+            self._average = self.Averager.average()
+        return self._average
+    
+    def result(self, Block):
+        Time1, Time2 = Block.time() if Block is not None else (np.zeros((self.npts,)), np.zeros((self.npts,)))
+        OutVoltageArray1, OutVoltageArray2 = self.average()
+        return OutVoltageArray1, OutVoltageArray2, Time1, Time2
+
+class WindowIntegral(Reducer):
+    """
+    Integrates the averaged records of both channels over one or more weighted windows.
+    The windows are linear in the records, so they are applied once to the averaged records.
+    Result: array of shape (n_windows, 2) with Channel1 (I) in the first and Channel2 (Q) in the second column
+    Parameters:
+        weights - array of shape (n_windows, npts) or function(npts) which returns it
+        trace - MeanTrace of the same measurement which is integrated, None to average the records separately
+    """
+    def __init__(self, weights, trace=None):
+        self.weights = weights
+        self.trace = trace
+        self._owns_trace = trace is None
+        if self._owns_trace:
+            self.trace = MeanTrace(publish_every=0)
+    
+    def prepare(self, digitizer, nacqs, nrcds, npts):
+        super().prepare(digitizer, nacqs, nrcds, npts)
+        self.Weights = np.atleast_2d(self.weights(npts) if callable(self.weights) else np.asarray(self.weights, dtype=np.float64))
+        if self.Weights.shape[1] != npts:
+            raise ValueError('The window weights have {0} points, but the records have {1}'.format(self.Weights.shape[1], npts))
+        if self._owns_trace:
+            self.trace.prepare(digitizer, nacqs, nrcds, npts)
+    
+    def add(self, Block):
+        if self._owns_trace:
+            self.trace.add(Block)
+    
+    def result(self, Block):
+        OutVoltageArray1, OutVoltageArray2 = self.trace.average()
+        with self.timer.stage('scale'):
+            return np.dot(self.Weights, np.stack((OutVoltageArray1, OutVoltageArray2), axis=1))
+
+class IQHistogram(Reducer):
+    """
+    Integrates every single record of both channels with the weights of one window and bins the (I, Q) pairs
+    into a fixed 2D histogram, so the memory does not depend on the number of records.
+    With a threshold, every record is also assigned a state by a linear discriminator: state 1 if
+    I*cos(angle) + Q*sin(angle) > level, else state 0. The states are counted for all records, also outside the histogram.
+    Result: (counts of shape (bins, bins) with I along the first axis, I bin edges, Q bin edges,
+             number of records outside the histogram, number of records in state 0 and 1)
+    Parameters:
+        weights - array of npts weights or function(npts) which returns it, e.g. np.full(npts, 1/npts) for the mean
+        I_range, Q_range - (min, max) of the histogram in V
+        bins - number of bins along I and Q
+        threshold - (angle in rad, level in V) of the discriminator, None to count no states
+    """
+    def __init__(self, weights, I_range, Q_range, bins=100, threshold=None):
+        self.weights = weights
+        self.I_edges = np.linspace(I_range[0], I_range[1], bins+1)
+        self.Q_edges = np.linspace(Q_range[0], Q_range[1], bins+1)
+        self.bins = bins
+        self.threshold = threshold
+    
+    def prepare(self, digitizer, nacqs, nrcds, npts):
+        super().prepare(digitizer, nacqs, nrcds, npts)
+        self.Weights = np.ravel(self.weights(npts) if callable(self.weights) else np.asarray(self.weights, dtype=np.float64))
+        if len(self.Weights) != npts:
+            raise ValueError('The window weights have {0} points, but the records have {1}'.format(len(self.Weights), npts))
+        self.WeightSum = self.Weights.sum()
+        self.Counts = np.zeros(self.bins*self.bins, dtype=np.int64)
+        self.Outliers = 0
+        self.StateCounts = np.zeros(2, dtype=np.int64)
+    
+    def integrate(self, Block):
+        """ returns the integrated I and Q of every record of a block in volts """
+        I = np.dot(Block.Codes1, self.Weights)
+        Q = np.dot(Block.Codes2, self.Weights)
+        I *= Block.ScaleFactor1
+        I += Block.ScaleOffset1*self.WeightSum
+        Q *= Block.ScaleFactor2
+        Q += Block.ScaleOffset2*self.WeightSum
+        return I, Q
+    
+    def add(self, Block):
+        with self.timer.stage('accumulate'):
+            I, Q = self.integrate(Block)
+            self.add_points(I, Q)
+            if self.threshold is not None:
+                self.add_states(I, Q)
+    
+    def add_points(self, I, Q):
+        # equally spaced bins, so the bin index is computed directly instead of searched
+        iI = np.floor((I - self.I_edges[0])*(self.bins/(self.I_edges[-1] - self.I_edges[0]))).astype(np.int64)
+        iQ = np.floor((Q - self.Q_edges[0])*(self.bins/(self.Q_edges[-1] - self.Q_edges[0]))).astype(np.int64)
+        inside = (iI >= 0) & (iI < self.bins) & (iQ >= 0) & (iQ < self.bins)
+        self.Outliers += len(I) - np.count_nonzero(inside)
+        self.Counts += np.bincount(iI[inside]*self.bins + iQ[inside], minlength=self.bins*self.bins)
+    
+    def add_states(self, I, Q):
+        angle, level = self.threshold
+        excited = np.count_nonzero(I*np.cos(angle) + Q*np.sin(angle) > level)
+        self.StateCounts += (len(I) - excited, excited)
+    
+    def result(self, Block):
+        return self.Counts.reshape(self.bins, self.bins), self.I_edges, self.Q_edges, self.Outliers, self.StateCounts
+
+class RawSink(Reducer):
+    """
+    Keeps all records of both channels.
+    Result: (I, Q, TimeI, TimeQ) of shape (nacqs*nrcds, npts) in V and s, or for scaled=False
+    (I codes, Q codes, I scale, Q scale, TimeI, TimeQ) with the native int16 ADC codes and (ScaleFactor, ScaleOffset) of each channel,
+    which are fetched straight into the output arrays.
+    Parameters:
+        scaled - convert the records to volts while fetching
+        names - names of the output arrays, used for files in the ScratchDirectory of the digitizer
+    """
+    def __init__(self, scaled=True, names=None):
+        self.scaled = scaled
+        self.names = names if names is not None else (('I_data','Q_data') if scaled else ('I_codes','Q_codes'))
+    
+    def prepare(self, digitizer, nacqs, nrcds, npts):
+        super().prepare(digitizer, nacqs, nrcds, npts)
+        self.npts = npts
+        dtype = np.float64 if self.scaled else np.int16
+        self.Out1, self.Out2 = digitizer.allocate_records(self.names, (nacqs*nrcds,npts), dtype)
+        if not self.scaled:
+            self.out = (self.Out1, self.Out2)
+    
+    def add(self, Block):
+        if not self.scaled:
+            return
+        # scale the ADC codes straight into the output arrays
+        nrcds = Block.Codes1.shape[0]
+        rows = slice(Block.index*nrcds, (Block.index+1)*nrcds)
+        with self.timer.stage('scale'):
+            np.multiply(Block.Codes1, Block.ScaleFactor1, out=self.Out1[rows])
+            np.multiply(Block.Codes2, Block.ScaleFactor2, out=self.Out2[rows])
+            self.Out1[rows] += Block.ScaleOffset1
+            self.Out2[rows] += Block.ScaleOffset2
+    
+    def result(self, Block):
+        Time1, Time2 = Block.time() if Block is not None else (np.zeros((self.npts,)), np.zeros((self.npts,)))
+        if self.scaled:
+            return self.Out1, self.Out2, Time1, Time2
+        Scale1 = np.zeros((2,))
+        Scale2 = np.zeros((2,))
+        if Block is not None:
+            Scale1[:] = Block.ScaleFactor1, Block.ScaleOffset1
+            Scale2[:] = Block.ScaleFactor2, Block.ScaleOffset2
+        return self.Out1, self.Out2, Scale1, Scale2, Time1, Time2
+
+class PowerSpectrum(Reducer):
+    """
+    Welch power spectral density of both channels and their cross-spectrum, accumulated over all records.
+    Every record is split into segments of nperseg points with 50 % overlap, the mean of each segment is removed,
+    a Hann window is applied and the FFTs are accumulated. The records of each acquisition are divided among a pool
+    of worker threads, numpy releases the GIL in the FFT, so the FFTs keep up with the fetching. Each worker
+    transforms BatchPoints points at a time, so the memory needed does not depend on the size of the acquisition.
+    Result: (frequencies in Hz, one-sided PSD of I and of Q in V^2/Hz, cross-spectral density of I and Q in V^2/Hz)
+    Parameters:
+        nperseg - points per segment, None for whole records
+        workers - number of worker threads
+    """
+    BatchPoints = 2**16     # points of the segments which a worker transforms at once
+    
+    def __init__(self, nperseg=None, workers=None):
+        self.nperseg = nperseg
+        self.workers = workers if workers is not None else min(4, os.cpu_count() or 1)
+        self._executor = None
+    
+    def prepare(self, digitizer, nacqs, nrcds, npts):
+        super().prepare(digitizer, nacqs, nrcds, npts)
+        nperseg = npts if self.nperseg is None else self.nperseg
+        if not 2 <= nperseg <= npts:
+            raise ValueError('The segment length must be between 2 and RecordSize ({0})'.format(npts))
+        self.SampleRate = digitizer.SampleRate()
+        self.Window = np.hanning(nperseg + 1)[:-1] if nperseg > 2 else np.ones(nperseg)   # periodic Hann window
+        step = max(nperseg//2, 1)
+        self.Starts = np.arange(0, npts - nperseg + 1, step)
+        nfreqs = nperseg//2 + 1
+        self.Sum11 = np.zeros(nfreqs)
+        self.Sum22 = np.zeros(nfreqs)
+        self.Sum12 = np.zeros(nfreqs, dtype=np.complex128)
+        self.NumSegments = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='{0}_psd'.format(digitizer.name))
+    
+    def _spectra(self, Codes1, Codes2, ScaleFactor1, ScaleFactor2):
+        # partial sums of the spectra of some records, the scale offset drops out with the segment mean
+        # the segments are processed in batches of BatchPoints points through one buffer, so the memory
+        # does not grow with the number of records
+        nperseg = len(self.Window)
+        nsegments = len(self.Starts)
+        total = Codes1.shape[0]*nsegments
+        batch = min(max(self.BatchPoints//nperseg, 1), total)
+        Segments = np.empty((batch, nperseg))
+        nfreqs = nperseg//2 + 1
+        Sum11 = np.zeros(nfreqs)
+        Sum22 = np.zeros(nfreqs)
+        Sum12 = np.zeros(nfreqs, dtype=np.complex128)
+        for first in range(0, total, batch):
+            segment = np.arange(first, min(first + batch, total))
+            rows = (segment//nsegments)[:, None]
+            index = self.Starts[segment % nsegments][:, None] + np.arange(nperseg)
+            Spectrum1 = self._spectrum(Codes1, rows, index, Segments[:len(segment)])
+            Spectrum2 = self._spectrum(Codes2, rows, index, Segments[:len(segment)])
+            Sum11 += np.einsum('jk,jk->k', Spectrum1.real, Spectrum1.real) + np.einsum('jk,jk->k', Spectrum1.imag, Spectrum1.imag)
+            Sum22 += np.einsum('jk,jk->k', Spectrum2.real, Spectrum2.real) + np.einsum('jk,jk->k', Spectrum2.imag, Spectrum2.imag)
+            Sum12 += np.einsum('jk,jk->k', Spectrum1, Spectrum2.conj())
+        return Sum11*ScaleFactor1**2, Sum22*ScaleFactor2**2, Sum12*(ScaleFactor1*ScaleFactor2)
+    
+    def _spectrum(self, Codes, rows, index, Segments):
+        # FFT of the windowed segments Codes[rows, index] without their means, Segments is the work buffer
+        Segments[...] = Codes[rows, index]
+        Segments -= Segments.mean(axis=-1, keepdims=True)
+        Segments *= self.Window
+        return np.fft.rfft(Segments, axis=-1)
+    
+    def add(self, Block):
+        nrcds = Block.Codes1.shape[0]
+        chunk = -(-nrcds//self.workers)
+        with self.timer.stage('accumulate'):
+            # the block is reused after add() returns, so all chunks are finished here
+            futures = [self._executor.submit(self._spectra, Block.Codes1[k:k+chunk], Block.Codes2[k:k+chunk], Block.ScaleFactor1, Block.ScaleFactor2)
+                       for k in range(0, nrcds, chunk)]
+            for future in futures:
+                Sum11, Sum22, Sum12 = future.result()
+                self.Sum11 += Sum11
+                self.Sum22 += Sum22
+                self.Sum12 += Sum12
+        self.NumSegments += nrcds*len(self.Starts)
+    
+    def result(self, Block):
+        self.close()
+        SampleRate = 1/Block.XIncrement1 if Block is not None and Block.XIncrement1 > 0 else self.SampleRate
+        nperseg = len(self.Window)
+        Frequencies = np.fft.rfftfreq(nperseg, 1/SampleRate)
+        # one-sided density: all bins except DC and Nyquist contain the power of the negative frequencies
+        Scale = np.full(len(Frequencies), 2.0/(SampleRate*np.sum(self.Window**2)*max(self.NumSegments, 1)))
+        Scale[0] /= 2
+        if nperseg % 2 == 0:
+            Scale[-1] /= 2
+        return Frequencies, self.Sum11*Scale, self.Sum22*Scale, self.Sum12*Scale
+    
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
 
 class IQArray_raw(MultiParameter):
     """
@@ -38,59 +693,72 @@ class IQArray_raw(MultiParameter):
 
         
     def get_raw(self):
-        self._instrument.start()                  # Initiates a waveform acquisition. The digitizer waits for a trigger.
-       
-        # update nacqs, nrcds and npts values
-        self.__nacqs = self._instrument.NumberOfAcquisitions()
-        self.__nrcds = self._instrument.NumRecordsPerAcquisition()
-        self.__npts = self._instrument.RecordSize()
-        
-        # define output data arrays
-        OutVoltageArrays1 = np.zeros((self.__nacqs*self.__nrcds,self.__npts))
-        OutVoltageArrays2 = np.zeros((self.__nacqs*self.__nrcds,self.__npts))
-        Time1 = np.zeros((1,self.__npts))
-        Time2 = np.zeros((1,self.__npts))
-        
-        # fetch data
-        print('Fetching data...')
-        print('Number of Acquisitions: ',self.__nacqs)
-        print('Number of Records Per Acquisition: ',self.__nrcds)
-        start_time = time() # get time stamp
-        for i in range(self.__nacqs):
-            NoErrorCheck = self._instrument.WaitUntilAcqComplete() # Indicates if a (single- or multi-record) waveform can be fetched from the instrument.
-            if NoErrorCheck == False: 
-                break 
-            for j in range(self.__nrcds):
-                # This function returns the waveform the digitizer acquired for the specified channel in raw ADC units.
-                [__OutArray1, __ActualPoints1, __FirstValidPoint1, __InitialXOffset1, __InitialXTimeSeconds1, __InitialXTimeFraction1, __XIncrement1, __ScaleFactor1, __ScaleOffset1] = self._instrument.AgMD2.Channels('Channel1').Measurement.FetchWaveformInt16()
-                [__OutArray2, __ActualPoints2, __FirstValidPoint2, __InitialXOffset2, __InitialXTimeSeconds2, __InitialXTimeFraction2, __XIncrement2, __ScaleFactor2, __ScaleOffset2] = self._instrument.AgMD2.Channels('Channel2').Measurement.FetchWaveformInt16()
-                ##############################
-                # Outputs:
-                # OutArray:  Buffer into which the acquired waveform is stored.
-                # ActualPoints: Indicates how many data points were actually retrieved from the instrument.
-                # FirstValidPoint: Indicates the index of the first valid data point in the output data array.
-                # InitialXOffset: The time in relation to the Trigger Event of the first point in the waveform in seconds. Negative values mean that the first point in the waveform array was acquired before the trigger event.
-                # InitialXTimeSeconds: Specifies the seconds portion of the absolute time at which the first data point was acquired. Note that the actual time is the sum of InitialXTimeSeconds and InitialXTimeFraction.
-                # InitialXTimeFraction: Specifies the fractional portion of the absolute time at which the first data point was acquired. Note that the actual time is the sum of InitialXTimeSeconds and InitialXTimeFraction.
-                # XIncrement: The time between points in the acquired waveform in seconds.
-                # ScaleFactor: Scaling factor for the waveform data.
-                # ScaleOffset: Scaling offset for the waveform data.
-                VoltageArray1 = __ScaleOffset1 + np.multiply(__OutArray1[__FirstValidPoint1:__FirstValidPoint1+__ActualPoints1],__ScaleFactor1)
-                VoltageArray2 = __ScaleOffset2 + np.multiply(__OutArray2[__FirstValidPoint2:__FirstValidPoint2+__ActualPoints2],__ScaleFactor2)
-                OutVoltageArrays1[i*self.__nrcds+j,:] = VoltageArray1
-                OutVoltageArrays2[i*self.__nrcds+j,:] = VoltageArray2
-            self._instrument.continue_acquisition() 
-
-        if NoErrorCheck == True:
-            # To optimize the memory size, keep only single array of time data for each channel
-            Time1 = np.linspace(__InitialXOffset1,__InitialXOffset1+__ActualPoints1*__XIncrement1,__ActualPoints1)
-            Time2 = np.linspace(__InitialXOffset2,__InitialXOffset2+__ActualPoints2*__XIncrement2,__ActualPoints2)
-            self._instrument.stop() # stop acquisition            
-         
-        
-        print('get() of "IQArray_raw" was executed in {0} s'.format(time()-start_time))
-        print('If running QCoDes Measure() or Loop() function: Waiting for QCoDes to write the data to a file.')
-        return OutVoltageArrays1, OutVoltageArrays2, Time1, Time2
+        return self._instrument.measure(RawSink(), name='IQArray_raw')[0]
+
+class IQArray_raw_int16(MultiParameter):
+    """
+    MultiParameter class for IQ data in raw ADC units
+    Records are kept as the native int16 ADC codes together with (ScaleFactor, ScaleOffset) of each channel,
+    use ScaledRecords to convert them to volts when needed.
+    Parameters:
+        nacqs - number of acquisitions
+        nrcds - number of records per one acquisition
+        npts - number of points
+    """
+    def __init__(self, name, instrument, nacqs, nrcds, npts):
+        super().__init__(name,
+                         names=('I_codes','Q_codes','I_scale','Q_scale','I_time','Q_time'),
+                         shapes=((), (), (), (), (), ()),
+                         labels=('I_out', 'Q_out','I_scale','Q_scale','I_time', 'Q_time'),
+                         units=('ADC', 'ADC','','','s','s'))                        
+        
+        # Read instrument parameters
+        self._instrument = instrument
+        
+        # Set shapes
+        self.update_shapes(nacqs, nrcds, npts)
+        
+        self.setpoint_names = (('I_raw_nrcds','I_raw_npts'), ('Q_raw_nrcds','Q_raw_npts'), ('I_scale_index',), ('Q_scale_index',), ('TimeI_raw_npts',), ('TimeQ_raw_npts',))
+
+    def update_shapes(self,nacqs, nrcds, npts):
+        self.shapes = ((nacqs*nrcds,npts), (nacqs*nrcds,npts),(2,),(2,),(npts,),(npts,))
+
+    def get_raw(self):
+        return self._instrument.measure(RawSink(scaled=False), name='IQArray_raw_int16')[0]
+
+class ScaledRecords:
+    """
+    Read-only view of int16 ADC records that converts to volts only when accessed.
+    Indexing returns the selected records in volts, chunks() converts the records block by block.
+    Parameters:
+        codes - int16 array of raw ADC codes, e.g. I_codes of IQ_data_raw_int16
+        scale - (ScaleFactor, ScaleOffset) of the channel, e.g. I_scale of IQ_data_raw_int16
+    """
+    def __init__(self, codes, scale):
+        self.codes = codes
+        self.ScaleFactor = float(scale[0])
+        self.ScaleOffset = float(scale[1])
+    
+    @property
+    def shape(self):
+        return self.codes.shape
+    
+    def __len__(self):
+        return len(self.codes)
+    
+    def __getitem__(self, index):
+        VoltageArray = np.multiply(self.codes[index], self.ScaleFactor, dtype=np.float64)
+        VoltageArray += self.ScaleOffset
+        return VoltageArray
+    
+    def __array__(self, dtype=None, copy=None):
+        VoltageArray = self[...]
+        return VoltageArray if dtype is None else VoltageArray.astype(dtype)
+    
+    def chunks(self, nrcds):
+        """ yields (first record index, records in volts) for blocks of nrcds records """
+        for start in range(0, len(self.codes), nrcds):
+            yield start, self[start:start+nrcds]
 
 class IQArray_averaged(MultiParameter):
     """
@@ -118,67 +786,7 @@ class IQArray_averaged(MultiParameter):
 
         
     def get_raw(self):
-        self._instrument.start()                  # Initiates a waveform acquisition. The digitizer waits for a trigger.
-        
-        # update nacqs, nrcds and npts values
-        self.__nacqs = self._instrument.NumberOfAcquisitions()
-        self.__nrcds = self._instrument.NumRecordsPerAcquisition()
-        self.__npts = self._instrument.RecordSize()
-        
-        # fetch data
-        print('Fetching data...')
-        print('Number of Acquisitions: ', self.__nacqs)
-        print('Number of Records Per Acquisition: ', self.__nrcds)
-        print('**Number of Averages (= NumberOfAcquisitions x NumberOfRecordsPerAcquisition): ', self.__nacqs*self.__nrcds,'**')
-        
-        start_time = time() # get time stamp
-        
-        # define output data arrays
-        OutVoltageArrays1i = np.zeros((self.__npts,))
-        OutVoltageArrays2i = np.zeros((self.__npts,))
-        Time1 = np.zeros((self.__npts,))
-        Time2 = np.zeros((self.__npts,))
-        
-        for i in range(self.__nacqs):
-            NoErrorCheck = self._instrument.WaitUntilAcqComplete() # Indicates if a (single- or multi-record) waveform can be fetched from the instrument.
-            if NoErrorCheck == False: 
-                break
-            for j in range(self.__nrcds):
-                OutVoltageArrays1j = np.zeros((self.__npts,))    # initialize a temporary array for averaging
-                OutVoltageArrays2j = np.zeros((self.__npts,))    # initialize a temporary array for averaging
-                # This function returns the waveform the digitizer acquired for the specified channel in raw ADC units.
-                [__OutArray1, __ActualPoints1, __FirstValidPoint1, __InitialXOffset1, __InitialXTimeSeconds1, __InitialXTimeFraction1, __XIncrement1, __ScaleFactor1, __ScaleOffset1] = self._instrument.AgMD2.Channels('Channel1').Measurement.FetchWaveformInt16()
-                [__OutArray2, __ActualPoints2, __FirstValidPoint2, __InitialXOffset2, __InitialXTimeSeconds2, __InitialXTimeFraction2, __XIncrement2, __ScaleFactor2, __ScaleOffset2] = self._instrument.AgMD2.Channels('Channel2').Measurement.FetchWaveformInt16()
-                ##############################
-                # Outputs:
-                # OutArray:  Buffer into which the acquired waveform is stored.
-                # ActualPoints: Indicates how many data points were actually retrieved from the instrument.
-                # FirstValidPoint: Indicates the index of the first valid data point in the output data array.
-                # InitialXOffset: The time in relation to the Trigger Event of the first point in the waveform in seconds. Negative values mean that the first point in the waveform array was acquired before the trigger event.
-                # InitialXTimeSeconds: Specifies the seconds portion of the absolute time at which the first data point was acquired. Note that the actual time is the sum of InitialXTimeSeconds and InitialXTimeFraction.
-                # InitialXTimeFraction: Specifies the fractional portion of the absolute time at which the first data point was acquired. Note that the actual time is the sum of InitialXTimeSeconds and InitialXTimeFraction.
-                # XIncrement: The time between points in the acquired waveform in seconds.
-                # ScaleFactor: Scaling factor for the waveform data.
-                # ScaleOffset: Scaling offset for the waveform data.
-                VoltageArray1 = __ScaleOffset1 + np.multiply(__OutArray1[__FirstValidPoint1:__FirstValidPoint1+__ActualPoints1],__ScaleFactor1)
-                VoltageArray2 = __ScaleOffset2 + np.multiply(__OutArray2[__FirstValidPoint2:__FirstValidPoint2+__ActualPoints2],__ScaleFactor2)
-                
-                # averaging over records
-                OutVoltageArrays1j = (OutVoltageArrays1j*j + VoltageArray1)/(j+1)
-                OutVoltageArrays2j = (OutVoltageArrays2j*j + VoltageArray2)/(j+1)
-            self._instrument.continue_acquisition() 
-            # averaging over acquisitions
-            OutVoltageArrays1i = (OutVoltageArrays1i*i + OutVoltageArrays1j)/(i+1)
-            OutVoltageArrays2i = (OutVoltageArrays2i*i + OutVoltageArrays2j)/(i+1)
-            
-        if NoErrorCheck == True:
-            Time1 = np.linspace(__InitialXOffset1,__InitialXOffset1+__ActualPoints1*__XIncrement1,__ActualPoints1)
-            Time2 = np.linspace(__InitialXOffset2,__InitialXOffset2+__ActualPoints2*__XIncrement2,__ActualPoints2)
-            self._instrument.stop() # stop acquisition
-        
-        print('get() of "IQArray_averaged" was executed in {0} s'.format(time()-start_time))
-        print('If running QCoDes Measure() or Loop() function: Waiting for QCoDes to write the data to a file.')
-        return OutVoltageArrays1i, OutVoltageArrays2i, Time1, Time2    
+        return self._instrument.measure(MeanTrace(), name='IQArray_averaged')[0]
     
 class Keysight_M9203A_Channel(InstrumentChannel):
     """
@@ -217,30 +825,64 @@ class Keysight_M9203A_Channel(InstrumentChannel):
         self._channel = channel
         
     def get_offset(self):
-        return self._parent.AgMD2.Channels(self._channel).Offset
+        return self._parent.cached_get((self._channel, 'Offset'), lambda: self._parent.AgMD2.Channels(self._channel).Offset)
     
     def set_offset(self,value):
-        self._parent.AgMD2.Channels(self._channel).Offset = value
+        self._parent.cached_set((self._channel, 'Offset'), lambda: setattr(self._parent.AgMD2.Channels(self._channel), 'Offset', value))
     
     def get_range(self):
-        return self._parent.AgMD2.Channels(self._channel).Range
+        return self._parent.cached_get((self._channel, 'Range'), lambda: self._parent.AgMD2.Channels(self._channel).Range)
     
     def set_range(self,value):
-        self._parent.AgMD2.Channels(self._channel).Range = value
+        self._parent.cached_set((self._channel, 'Range'), lambda: setattr(self._parent.AgMD2.Channels(self._channel), 'Range', value))
         
 
         
-class M9203A(Instrument):
+class M9203A(DriverValueCache, Instrument):
     """
     QCoDeS driver for Keysight M9203A 2-channel digitizer.
     This driver was written for use with the custom-made spectrometer in the Quantum Spin Dynamics group at UCL
+    The vendor driver is only loaded when the instrument is created.
+    Parameters:
+        backend - 'real' for the AgMD2 COM driver, 'emulated' for AgMD2Emulator.EmulatedAgMD2
+        driver - object implementing the AgMD2 driver interface which is used instead of the backend, e.g. a configured EmulatedAgMD2
     """
-    def __init__(self, name, address, **kwargs):
+    def __init__(self, name, address, backend='real', driver=None, **kwargs):
         # supplying the terminator means you don't need to remove it from every response
         super().__init__(name, **kwargs)
       
+        if backend not in ('real', 'emulated'):
+            raise ValueError('backend must be either "real" or "emulated"')
+        self.backend = backend
+        self.__UsesCOM = driver is None and backend == 'real'     # COM has to be initialized in the fetch thread
+        
         # Create instance of Keysight AgMD2 class
-        self.AgMD2 = comtypes.client.CreateObject("AgMD2.AgMD2")
+        self.__ThreadDriver = threading.local()    # marshaled driver of a fetch or worker thread, see init_fetch_thread
+        self.__DriverCookie = None                 # Global Interface Table cookie of the COM driver
+        self.__DriverInMTA = False                 # the COM driver was created in the multithreaded apartment
+        if driver is not None:
+            self.__AgMD2 = driver
+        elif backend == 'emulated':
+            from qcodes.instrument_drivers.Keysight.AgMD2Emulator import EmulatedAgMD2
+            self.__AgMD2 = EmulatedAgMD2()
+        else:
+            # The driver has to be created in the multithreaded apartment (MTA). In a single-threaded apartment the
+            # proxies of the fetch and worker threads would send every call to this thread, which does not pump
+            # messages while it waits for them, so the first fetch would hang. comtypes initializes COM of the
+            # importing thread with sys.coinit_flags, 0 is COINIT_MULTITHREADED.
+            if 'comtypes' not in sys.modules:
+                sys.coinit_flags = 0
+            import comtypes.client # driver for IVI-COM
+            import comtypes.git
+            self.__DriverInMTA = _com_thread_in_mta()
+            if not self.__DriverInMTA:
+                log.warning('comtypes was imported with COM of this thread as single-threaded apartment, so FetchThread and the '
+                            'async API of Zoidberg2 cannot be used. Set sys.coinit_flags = 0 before comtypes is imported.')
+            self.__AgMD2 = comtypes.client.CreateObject("AgMD2.AgMD2")
+            # Other threads must not call the interface pointer of this thread directly,
+            # they get a marshaled proxy through the Global Interface Table instead.
+            self.__DriverInterface = type(self.__AgMD2)._type_
+            self.__DriverCookie = comtypes.git.RegisterInterfaceInGlobal(self.__AgMD2, self.__DriverInterface)
         
         initOptions = "Simulate=False"
         IdQuery = False        # If this is enabled, the driver will query the instrument model and compare it with a list of instrument models that is supported by the driver.
@@ -270,10 +912,33 @@ class M9203A(Instrument):
         self.__SampleRate = 1.6e9/16        # Specifies the sample rate in samples per second. Should be 1.6e9/(2**n) (where n is arbitrary integer?)
         self.__timeout = 1.0                # digitizer timeout in seconds
         
+        # For waiting on TSR acquisitions
+        self.__MinPollInterval = 50e-6      # first sleep between two polls of the driver in seconds
+        self.__MaxPollInterval = 10e-3      # longest sleep between two polls of the driver in seconds
+        self.__AcqPeriod = None             # estimated time between two completed acquisitions in seconds
+        self.__LastAcqCompleteTime = None   # time stamp of the last completed acquisition
+        self.reset_WaitStatistics()
+        self.timer = StageTimer()           # time spent in the stages of all acquisitions since the last reset_StageStatistics()
+        
         self.__NumberOfAcquisitions = 1     # number of acquisitions
         self.__NumberOfAverages = self.__NumberOfAcquisitions*self.__NumRecordsPerAcquisition # number of averages
 
         self.__AcquisitionMode = 'standard' # choose acquisition mode: standard or TSR
+        self.__FetchMode = 'bulk'           # choose fetch mode: record (one driver call per record) or bulk (one multi-record call per acquisition)
+        self.__ScratchDirectory = None      # directory for memory-mapped raw data, None keeps raw data in RAM
+        
+        # For progressive averaging, see MeanTrace
+        self.__PublishInterval = 0          # number of acquisitions between two published partial averages, 0 for none
+        self.__PublishCallback = None       # function(PartialAverage, number of acquisitions), returns True to stop
+        self.PartialAverage = None          # latest partial average of shape (2, RecordSize), shared with the running measurement
+        self.PartialAverageCount = 0        # number of acquisitions in PartialAverage
+        self.__FetchThread = False          # fetch acquisitions in a background thread while the previous one is processed
+        self.__PhaseCycle = None            # signs or complex receiver phases of the records within an acquisition, None for plain averaging
+        self.__PendingConfig = None         # changes of the acquisition configuration collected by acquisition_config()
+        self.__Configured = False           # whether the acquisition configuration has been sent to the driver
+        
+        # For the driver value cache, keys are (channel or trigger source, attribute)
+        self.init_driver_cache()
         
         self.add_parameter(name='AcquisitionMode',
                            label= 'Standard or TSR',
@@ -281,6 +946,43 @@ class M9203A(Instrument):
                            get_cmd = self.get_AcquisitionMode,
                            vals = vals.Enum('standard','TSR'))
         
+        self.add_parameter(name='FetchMode',
+                           label= 'Record-by-record or bulk fetch',
+                           set_cmd = self.set_FetchMode,
+                           get_cmd = self.get_FetchMode,
+                           vals = vals.Enum('record','bulk'))
+        
+        self.add_parameter(name='FetchThread',
+                           label= 'Fetch in background thread',
+                           set_cmd = self.set_FetchThread,
+                           get_cmd = self.get_FetchThread,
+                           vals = vals.Bool())
+        
+        self.add_parameter(name='PhaseCycle',
+                           label= 'Phase cycle of the records within an acquisition',
+                           set_cmd = self.set_PhaseCycle,
+                           get_cmd = self.get_PhaseCycle,
+                           vals = vals.Anything())
+        
+        self.add_parameter(name='ScratchDirectory',
+                           label= 'Directory for memory-mapped raw data',
+                           set_cmd = self.set_ScratchDirectory,
+                           get_cmd = self.get_ScratchDirectory,
+                           vals = vals.MultiType(vals.Strings(), vals.Enum(None)))
+        
+        self.add_parameter(name='PublishInterval',
+                           label= 'Acquisitions between two published partial averages',
+                           set_cmd = self.set_PublishInterval,
+                           get_cmd = self.get_PublishInterval,
+                           vals = vals.Ints(0,BIGINT))
+        
+        self.add_parameter(name='PublishCallback',
+                           label= 'Function which receives the partial averages',
+                           set_cmd = self.set_PublishCallback,
+                           get_cmd = self.get_PublishCallback,
+                           snapshot_value = False,
+                           vals = vals.MultiType(vals.Callable(), vals.Enum(None)))
+        
         self.add_parameter(name='NumberOfAcquisitions',
                            label = 'Number of Acquisitions',
                            unit='',
@@ -302,6 +1004,16 @@ class M9203A(Instrument):
                            get_cmd=self.get_timeout,
                            vals = vals.Numbers(0,float('inf')))
 
+        self.add_parameter(name='WaitStatistics',
+                           label='TSR wait statistics',
+                           get_cmd=self.get_WaitStatistics,
+                           set_cmd=False)
+
+        self.add_parameter(name='StageStatistics',
+                           label='Acquisition stage timing statistics',
+                           get_cmd=self.get_StageStatistics,
+                           set_cmd=False)
+
         self.add_parameter(name = 'TriggerLevel', 
                            label = 'Digitizer Trigger Level',
                            unit = 'V',
@@ -343,6 +1055,12 @@ class M9203A(Instrument):
                            npts=self.RecordSize(),
                            parameter_class=IQArray_raw)
         
+        self.add_parameter(name='IQ_data_raw_int16',
+                           nacqs=self.NumberOfAcquisitions(),
+                           nrcds=self.NumRecordsPerAcquisition(),
+                           npts=self.RecordSize(),
+                           parameter_class=IQArray_raw_int16)
+        
         self.add_parameter(name='IQ_data_averaged',
                            nacqs=self.NumberOfAcquisitions(),
                            nrcds=self.NumRecordsPerAcquisition(),
@@ -355,6 +1073,48 @@ class M9203A(Instrument):
     def get_AcquisitionMode(self):
         return self.__AcquisitionMode
 
+    def set_FetchMode(self,value):
+        self.__FetchMode = value
+    
+    def get_FetchMode(self):
+        return self.__FetchMode
+
+    def set_FetchThread(self,value):
+        self.__FetchThread = value
+    
+    def get_FetchThread(self):
+        return self.__FetchThread
+    
+    def set_PhaseCycle(self,value):
+        if value is not None:
+            value = np.asarray(value, dtype=np.complex128)
+            if value.ndim != 1 or len(value) == 0:
+                raise ValueError('PhaseCycle must be None or a non-empty sequence of signs or complex phases')
+        self.__PhaseCycle = value
+    
+    def get_PhaseCycle(self):
+        return self.__PhaseCycle
+    
+    def set_ScratchDirectory(self,value):
+        if value is not None and not os.path.isdir(value):
+            raise ValueError('ScratchDirectory {0} does not exist'.format(value))
+        self.__ScratchDirectory = value
+    
+    def get_ScratchDirectory(self):
+        return self.__ScratchDirectory
+
+    def set_PublishInterval(self,value):
+        self.__PublishInterval = value
+    
+    def get_PublishInterval(self):
+        return self.__PublishInterval
+    
+    def set_PublishCallback(self,value):
+        self.__PublishCallback = value
+    
+    def get_PublishCallback(self):
+        return self.__PublishCallback
+    
     def set_NumberOfAcquisitions(self,value):
         self.__NumberOfAcquisitions = value
         self.__NumberOfAverages = self.__NumberOfAcquisitions*self.__NumRecordsPerAcquisition
@@ -373,33 +1133,94 @@ class M9203A(Instrument):
         return self.__timeout
         
     def set_trigger_type(self,value):
-        self.AgMD2.Trigger.ActiveSource = value # Specifies the source the digitizer monitors for the trigger event.        
+        self.cached_set(('Trigger', 'ActiveSource'), lambda: setattr(self.AgMD2.Trigger, 'ActiveSource', value)) # Specifies the source the digitizer monitors for the trigger event.        
         
     def get_trigger_type(self):
-        return self.AgMD2.Trigger.ActiveSource # Specifies the source the digitizer monitors for the trigger event.
+        return self.cached_get(('Trigger', 'ActiveSource'), lambda: self.AgMD2.Trigger.ActiveSource) # Specifies the source the digitizer monitors for the trigger event.
        
     def set_trigger_level(self,value):
         TriggerType = self.TriggerType()
-        self.AgMD2.Trigger.Sources[TriggerType].Level = value # Specifies the voltage threshold for the trigger sub-system
+        self.cached_set((TriggerType, 'Level'), lambda: setattr(self.AgMD2.Trigger.Sources[TriggerType], 'Level', value)) # Specifies the voltage threshold for the trigger sub-system
         
     def get_trigger_level(self):
         TriggerType = self.TriggerType()
-        return self.AgMD2.Trigger.Sources[TriggerType].Level # Specifies the voltage threshold for the trigger sub-system
+        return self.cached_get((TriggerType, 'Level'), lambda: self.AgMD2.Trigger.Sources[TriggerType].Level) # Specifies the voltage threshold for the trigger sub-system
 
     def set_NumRecordsPerAcquisition(self, value):
-        self.AgMD2.Acquisition3.ConfigureAcquisition(value, self.__RecordSize, self.__SampleRate) # This function configures the most commonly configured attributes of the digitizer acquisition sub-system
-        self.__NumRecordsPerAcquisition = value
-        self.__NumberOfAverages = self.__NumberOfAcquisitions*self.__NumRecordsPerAcquisition
-        self._update_IQArray_shapes()
+        self._configure(NumRecordsPerAcquisition=value)
     
     def get_NumRecordsPerAcquisition(self):
+        if self.__PendingConfig is not None:
+            return self.__PendingConfig.get('NumRecordsPerAcquisition', self.__NumRecordsPerAcquisition)
         return self.__NumRecordsPerAcquisition
     
     def set_RecordSize(self, value):
-       self.AgMD2.Acquisition3.ConfigureAcquisition(self.__NumRecordsPerAcquisition, int(value), self.__SampleRate) # This function configures the most commonly configured attributes of the digitizer acquisition sub-system
-       self.__RecordSize = int(value)
-       self._update_IQArray_shapes()
-       print('Record Size is set to ', self.__RecordSize)
+        self._configure(RecordSize=int(value))
+    
+    def _configure(self, **changes):
+        # collects the changes inside acquisition_config(), applies them immediately otherwise
+        if self.__PendingConfig is not None:
+            self.__PendingConfig.update(changes)
+        else:
+            self.configure_acquisition(**changes)
+    
+    def validate_acquisition(self, NumRecordsPerAcquisition, RecordSize, SampleRate, AcquisitionMode=None):
+        """
+        Raises a ValueError if the combination does not fit into the acquisition memory.
+        In TSR mode at least two acquisitions have to fit, so the digitizer can acquire while the previous one is fetched.
+        """
+        AcquisitionMode = self.__AcquisitionMode if AcquisitionMode is None else AcquisitionMode
+        if NumRecordsPerAcquisition < 1 or RecordSize < 1:
+            raise ValueError('NumRecordsPerAcquisition and RecordSize must be positive')
+        if not 0 < SampleRate <= MAX_SAMPLE_RATE:
+            raise ValueError('SampleRate must be between 0 and {0:e} Hz'.format(MAX_SAMPLE_RATE))
+        max_samples = MAX_SAMPLES_PER_CHANNEL//2 if AcquisitionMode == 'TSR' else MAX_SAMPLES_PER_CHANNEL
+        if NumRecordsPerAcquisition*RecordSize > max_samples:
+            raise ValueError('{0} records of {1} samples exceed the {2} acquisition memory of {3} samples per channel'.format(NumRecordsPerAcquisition, RecordSize, AcquisitionMode, max_samples))
+    
+    def configure_acquisition(self, NumRecordsPerAcquisition=None, RecordSize=None, SampleRate=None):
+        """
+        Validates the new combination of NumRecordsPerAcquisition, RecordSize and SampleRate
+        and sends it to the digitizer with a single ConfigureAcquisition call. Values which are None are not changed.
+        """
+        nrcds = self.__NumRecordsPerAcquisition if NumRecordsPerAcquisition is None else NumRecordsPerAcquisition
+        npts = self.__RecordSize if RecordSize is None else int(RecordSize)
+        rate = self.__SampleRate if SampleRate is None else SampleRate
+        self.validate_acquisition(nrcds, npts, rate)
+        if not self.__Configured or (nrcds, npts, rate) != (self.__NumRecordsPerAcquisition, self.__RecordSize, self.__SampleRate):
+            self.AgMD2.Acquisition3.ConfigureAcquisition(nrcds, npts, rate) # This function configures the most commonly configured attributes of the digitizer acquisition sub-system
+            self.__Configured = True
+        self.__NumRecordsPerAcquisition = nrcds
+        self.__RecordSize = npts
+        self.__SampleRate = rate
+        self.__NumberOfAverages = self.__NumberOfAcquisitions*self.__NumRecordsPerAcquisition
+        self._update_IQArray_shapes()
+        if RecordSize is not None:
+            log.info('Record Size is set to %d', self.__RecordSize)
+        if SampleRate is not None:
+            log.info('Sample Rate is set to %e Hz', self.__SampleRate)
+    
+    @contextmanager
+    def acquisition_config(self):
+        """
+        Context manager which collects the changes of NumRecordsPerAcquisition, RecordSize and SampleRate
+        and commits them with a single validated ConfigureAcquisition call when the block is left.
+        If the block raises, the changes are discarded.
+        Example:
+            with dig.acquisition_config():
+                dig.NumRecordsPerAcquisition(100)
+                dig.RecordSize(4096)
+                dig.SampleRate(1.6e9/4)
+        """
+        if self.__PendingConfig is not None:
+            raise RuntimeError('acquisition_config() is already active')
+        self.__PendingConfig = {}
+        try:
+            yield self
+            changes = self.__PendingConfig
+        finally:
+            self.__PendingConfig = None
+        self.configure_acquisition(**changes)
     
     def _update_IQArray_shapes(self):
         """ updates nrcds and npts of the IQArray_raw parameter"""
@@ -407,68 +1228,350 @@ class M9203A(Instrument):
         nrcds = self.NumRecordsPerAcquisition()
         npts = self.RecordSize()
         for _, parameter in self.parameters.items():
-            if isinstance(parameter, (IQArray_raw,IQArray_averaged)):
+            if isinstance(parameter, (IQArray_raw,IQArray_raw_int16,IQArray_averaged)):
                 try:
                     parameter.update_shapes(nacqs,nrcds,npts)
                 except AttributeError:
                     pass
                 
     def get_RecordSize(self):
+        if self.__PendingConfig is not None:
+            return self.__PendingConfig.get('RecordSize', self.__RecordSize)
         return self.__RecordSize
     
     def set_SampleRate(self, value):
-        self.AgMD2.Acquisition3.ConfigureAcquisition(self.__NumRecordsPerAcquisition, self.__RecordSize, value) # This function configures the most commonly configured attributes of the digitizer acquisition sub-system
-        self.__SampleRate = value 
-        print('Sample Rate is set to {0:e} Hz'.format(self.__SampleRate))
+        self._configure(SampleRate=value)
     
     def get_SampleRate(self):
+        if self.__PendingConfig is not None:
+            return self.__PendingConfig.get('SampleRate', self.__SampleRate)
         return self.__SampleRate
     
     def SelfCalibrate(self):
         self.AgMD2.Calibration.SelfCalibrate()   # Executes all internal calibrations.
     
     def start(self):
-        if self.AcquisitionMode() == 'TSR':           
-            self.AgMD2.Acquisition3.TSR.Enabled = 1    # Specifies whether TSR operation is enabled on the instrument.
-            if self.__NumRecordsPerAcquisition > (2**20/self.__RecordSize):
-                print('WARNING: NumRecordsPerAcquisition is not optimal. For optimal performance, use NumRecordsPerAcquisition <= 1 MB/RecordSize')
-                  
-        self.AgMD2.Acquisition3.Initiate()         # Initiates a waveform acquisition. The digitizer waits for a trigger.    
+        with self.timer.stage('arm'):
+            if self.AcquisitionMode() == 'TSR':           
+                self.validate_acquisition(self.__NumRecordsPerAcquisition, self.__RecordSize, self.__SampleRate, 'TSR')
+                self.AgMD2.Acquisition3.TSR.Enabled = 1    # Specifies whether TSR operation is enabled on the instrument.
+                if self.__NumRecordsPerAcquisition > (2**20/self.__RecordSize):
+                    log.warning('NumRecordsPerAcquisition is not optimal. For optimal performance, use NumRecordsPerAcquisition <= 1 MB/RecordSize')
+                      
+            self.reset_WaitStatistics()
+            self.__LastAcqCompleteTime = None
+            self.__AcqPeriod = None                    # the trigger rate of the previous run does not apply
+            self.AgMD2.Acquisition3.Initiate()         # Initiates a waveform acquisition. The digitizer waits for a trigger.    
         
                 
             
-    def WaitUntilAcqComplete(self):
+    def WaitUntilAcqComplete(self, *stop_events):
+        """
+        Waits until an acquisition can be fetched, returns False if it failed or was stopped.
+        Parameters:
+            stop_events - optional threading.Events, in TSR mode the wait returns False as soon as one of them is set,
+                          without stopping the acquisition or logging an error
+        """
         result = True
         if self.AcquisitionMode() == 'TSR':  
             start_time = time()
+            polls = 0
+            # Poll with sleeps in between, so the GIL and the CPU are free for other threads while waiting.
+            # The poll interval starts short and doubles up to a fraction of the observed acquisition period.
+            # The driver is polled before the first sleep, so completed acquisitions are drained without delay
+            # and the period estimate can follow a faster trigger rate.
+            poll_interval = self.__MinPollInterval
+            max_poll_interval = self.__MaxPollInterval
+            if self.__AcqPeriod is not None:
+                max_poll_interval = min(max_poll_interval, max(self.__AcqPeriod/8, self.__MinPollInterval))
             while True:
-                if self.AgMD2.Acquisition3.TSR.IsAcquisitionComplete == 1: # Read Only - Indicates if a (single- or multi-record) waveform can be fetched from the instrument. Applicable only when TSR operation is enabled.
-                    result=True
+                if any(stop_event.is_set() for stop_event in stop_events):
+                    result=False
                     break
-                if (time()-start_time) > self.__timeout:
-                    print('ERROR: Digitizer timeout occured. Acquisition stopped.')
-                    print('SOLUTION: Check the digitizer is triggered')
+                polls += 1
+                complete = self.AgMD2.Acquisition3.TSR.IsAcquisitionComplete == 1 # Read Only - Indicates if a (single- or multi-record) waveform can be fetched from the instrument. Applicable only when TSR operation is enabled.
+                # The overflow flag is read on every poll, also when an acquisition is complete: in steady state every
+                # poll finds a complete acquisition, and missed triggers would shift the records against the PhaseCycle.
+                if self.AgMD2.Acquisition3.TSR.MemoryOverflowOccurred == 1: # Indicates that no memory segment was available to acquire new data. The instrument could therefore not accept any new triggers, and some may have been missed.
+                    nacqs = self.__WaitStatistics['waits']
+                    log.error('Memory overflow occured after %d acquisitions (%d records), triggers were missed. Acquisition stopped. '
+                              'Reduce RecordSize and/or NumberOfRecordsPerAcquisition, or enable FetchThread.', nacqs, nacqs*self.__NumRecordsPerAcquisition)
                     self.stop()
                     result=False
                     break
-                if self.AgMD2.Acquisition3.TSR.MemoryOverflowOccurred == 1: # Indicates that no memory segment was available to acquire new data. The instrument could therefore not accept any new triggers, and some may have been missed.
-                    print('ERROR: Memory overflow occured. Acquisition stopped.')
-                    print('SOLUTION: Reduce RecordSize and/or NumberOfRecordsPerAcquisition')
+                if complete:
+                    result=True
+                    break
+                remaining_time = self.__timeout - (time()-start_time)
+                if remaining_time < 0:
+                    log.error('Digitizer timeout occured. Acquisition stopped. Check the digitizer is triggered.')
                     self.stop()
                     result=False
                     break
+                if stop_events:
+                    stop_events[0].wait(min(poll_interval, remaining_time))     # wakes up as soon as the wait is stopped
+                else:
+                    sleep(min(poll_interval, remaining_time))
+                poll_interval = min(2*poll_interval, max_poll_interval)
+            
+            # update the poll statistics and the estimate of the acquisition period
+            end_time = time()
+            if result and self.__LastAcqCompleteTime is not None:
+                period = end_time-self.__LastAcqCompleteTime
+                self.__AcqPeriod = period if self.__AcqPeriod is None else 0.8*self.__AcqPeriod + 0.2*period
+            self.__LastAcqCompleteTime = end_time if result else None
+            self.__WaitStatistics['waits'] += 1
+            self.__WaitStatistics['polls'] += polls
+            self.__WaitStatistics['wait_time'] += end_time-start_time
+            self.__WaitStatistics['max_wait_time'] = max(self.__WaitStatistics['max_wait_time'], end_time-start_time)
         else:
             self.AgMD2.Acquisition.WaitForAcquisitionComplete(1000*self.__timeout)  # timeout is in ms 
         return result
+    
+    def get_WaitStatistics(self):
+        """ returns the number of driver polls per acquisition and the wait latency since the last start() """
+        waits = max(self.__WaitStatistics['waits'], 1)
+        return {'waits': self.__WaitStatistics['waits'],
+                'polls': self.__WaitStatistics['polls'],
+                'polls_per_acquisition': self.__WaitStatistics['polls']/waits,
+                'mean_wait_time': self.__WaitStatistics['wait_time']/waits,
+                'max_wait_time': self.__WaitStatistics['max_wait_time'],
+                'acquisition_period': self.__AcqPeriod}
+    
+    def reset_WaitStatistics(self):
+        self.__WaitStatistics = {'waits': 0, 'polls': 0, 'wait_time': 0.0, 'max_wait_time': 0.0}
+    
+    def get_StageStatistics(self):
+        """ returns count, time and histogram of the arm, wait, fetch, scale, accumulate, continue and abort stages """
+        return self.timer.statistics()
+    
+    def reset_StageStatistics(self):
+        self.timer.reset()
+        
+    def allocate_records(self, names, shape, dtype):
+        """
+        Allocates output arrays for raw records.
+        If ScratchDirectory is set, each array is backed by a memory-mapped .npy file in that directory,
+        so that the size of a raw acquisition is limited by the disk space instead of the physical memory.
+        The disk space of all arrays is checked together and, where os.posix_fallocate is available, reserved
+        before the acquisition, so a full disk fails here instead of in a memory-mapped write while fetching.
+        The files are kept after the acquisition and can be reopened with np.load(filename, mmap_mode='r').
+        Parameters:
+            names - prefix of the file name of every array, e.g. ('I_data', 'Q_data'), a single name returns a single array
+            shape - shape of each array, e.g. (nacqs*nrcds, npts)
+            dtype - data type of the arrays
+        """
+        single = isinstance(names, str)
+        names = (names,) if single else tuple(names)
+        if self.__ScratchDirectory is None:
+            arrays = [np.zeros(shape, dtype=dtype) for _ in names]
+            return arrays[0] if single else arrays
+        
+        nbytes = len(names)*int(np.prod(shape))*np.dtype(dtype).itemsize
+        free = shutil.disk_usage(self.__ScratchDirectory).free
+        if nbytes > free:
+            raise ValueError('Not enough disk space in {0}: {1} bytes required, {2} bytes available'.format(self.__ScratchDirectory, nbytes, free))
+        arrays = []
+        filenames = []
+        try:
+            for name in names:
+                handle, filename = tempfile.mkstemp(prefix='{0}_{1}_'.format(self.name, name), suffix='.npy', dir=self.__ScratchDirectory)
+                os.close(handle)
+                filenames.append(filename)
+                arrays.append(np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape))
+                if hasattr(os, 'posix_fallocate'):
+                    # the memory-mapped file is sparse, reserve its blocks now
+                    with open(filename, 'r+b') as file:
+                        os.posix_fallocate(file.fileno(), 0, os.path.getsize(filename))
+        except OSError as error:
+            del arrays
+            for filename in filenames:
+                os.remove(filename)
+            raise ValueError('Not enough disk space in {0} for {1} bytes: {2}'.format(self.__ScratchDirectory, nbytes, error))
+        return arrays[0] if single else arrays
+    
+    def acquisitions(self, nacqs, nrcds, npts, out=None, stop_event=None):
+        """
+        Returns an AcquisitionPipeline over the acquisitions of the started digitizer.
+        Acquisitions are fetched in a background thread if FetchThread is enabled.
+        """
+        return AcquisitionPipeline(self, nacqs, nrcds, npts, threaded=self.__FetchThread, out=out, stop_event=stop_event)
+    
+    def averager(self, npts):
+        """
+        Returns a RecordAverager for records of npts points which applies the PhaseCycle.
+        """
+        return RecordAverager(npts, self.__PhaseCycle, self.timer)
+    
+    def measure(self, *reducers, start=None, stop=None, stop_event=None, name='measure'):
+        """
+        Runs one acquisition of NumberOfAcquisitions x NumRecordsPerAcquisition records and feeds every fetched
+        acquisition to all reducers, so several results are obtained from a single hardware run.
+        A reducer can end the measurement early with stop_requested, the results then contain the acquisitions so far, e.g.
+            trace = MeanTrace()
+            (I, Q, TimeI, TimeQ), IQ = dig.measure(trace, WindowIntegral(weights, trace))
+        Parameters:
+            reducers - Reducer instances, e.g. MeanTrace, WindowIntegral, IQHistogram or RawSink
+            start, stop - functions which arm and stop the acquisition, default start() and stop() of the digitizer
+            stop_event - optional threading.Event which ends the measurement early like stop_requested once set,
+                         also while waiting for a trigger
+            name - name of the measurement in the log
+        Returns:
+            list with the result of every reducer
+        """
+        nacqs = self.NumberOfAcquisitions()
+        nrcds = self.NumRecordsPerAcquisition()
+        npts = self.RecordSize()
         
+        try:
+            for reducer in reducers:
+                reducer.prepare(self, nacqs, nrcds, npts)
+            outs = [reducer.out for reducer in reducers if reducer.out is not None]
+            if len(outs) > 1:
+                raise ValueError('Only one reducer of a measurement can fetch straight into its arrays')
+            
+            try:
+                (start or self.start)()     # Initiates a waveform acquisition. The digitizer waits for a trigger.
+                
+                start_time = time() # get time stamp
+                Block = None
+                stopped = False
+                with self.acquisitions(nacqs, nrcds, npts, out=outs[0] if outs else None, stop_event=stop_event) as Pipeline:
+                    for Block in Pipeline:
+                        for reducer in reducers:
+                            reducer.add(Block)
+                        if any(reducer.stop_requested for reducer in reducers):
+                            stopped = True
+                            break
+                    if stop_event is not None and stop_event.is_set():
+                        stopped = True      # the pipeline ended at the stop event, not at a failed acquisition
+            except BaseException:
+                # e.g. a failing reducer, fetch error or KeyboardInterrupt: do not leave the hardware armed and generating
+                (stop or self.stop)()
+                raise
+            
+            if Pipeline.completed or stopped:
+                (stop or self.stop)() # stop acquisition
+            else:
+                Block = None
+            
+            results = [reducer.result(Block) for reducer in reducers]
+        finally:
+            for reducer in reducers:
+                reducer.close()
+        log_acquisition(name, nacqs, nrcds, time()-start_time, Pipeline.NumFetchedRecords)
+        return results
+    
+    @property
+    def AgMD2(self):
+        """ the driver, in a thread set up with init_fetch_thread() the proxy of that thread """
+        return getattr(self.__ThreadDriver, 'AgMD2', self.__AgMD2)
+    
+    def init_fetch_thread(self):
+        # COM has to be initialized in every thread that calls the driver, and the driver has to be marshaled into it
+        if self.__UsesCOM:
+            if not self.__DriverInMTA:
+                raise RuntimeError('The AgMD2 driver was created in a single-threaded COM apartment, other threads cannot call it. '
+                                   'Disable FetchThread, or set sys.coinit_flags = 0 before comtypes is imported.')
+            import comtypes
+            import comtypes.git
+            comtypes.CoInitializeEx(comtypes.COINIT_MULTITHREADED)
+            self.__ThreadDriver.AgMD2 = comtypes.git.GetInterfaceFromGlobal(self.__DriverCookie, self.__DriverInterface)
+    
+    def exit_fetch_thread(self):
+        if self.__UsesCOM and hasattr(self.__ThreadDriver, 'AgMD2'):
+            import comtypes
+            # the proxy has to be released before COM is uninitialized in this thread
+            del self.__ThreadDriver.AgMD2
+            comtypes.CoUninitialize()
+    
+    def fetch_records(self, channel, nrcds, npts, out):
+        """
+        Fetches all records of the current acquisition of one channel in raw ADC units.
+        Parameters:
+            channel - the name used by the Keysight, i.e. either 'Channel1' or 'Channel2'
+            nrcds - number of records to fetch
+            npts - number of points per record
+            out - int16 array of shape (nrcds, npts) into which the records are written
+        Returns:
+            ScaleFactor, ScaleOffset - scaling of the ADC codes to volts (volts = ScaleOffset + ScaleFactor*code)
+            InitialXOffset, XIncrement - time of the first point relative to the trigger and time between points in seconds
+        """
+        if self.__FetchMode == 'bulk':
+            # This function returns all records of the acquisition for the specified channel in raw ADC units with a single driver call.
+            [OutArray, ActualRecords, ActualPoints, FirstValidPoint, InitialXOffset, InitialXTimeSeconds, InitialXTimeFraction, XIncrement, ScaleFactor, ScaleOffset] = self.AgMD2.Channels(channel).MultiRecordMeasurement.FetchMultiRecordWaveformInt16(0, nrcds, 0, npts)
+            ##############################
+            # Outputs are the same as for FetchWaveformInt16, except that
+            # ActualRecords: Indicates how many records were actually retrieved from the instrument.
+            # ActualPoints, FirstValidPoint, InitialXOffset, InitialXTimeSeconds, InitialXTimeFraction: One entry per record.
+            # Record k is stored in OutArray[FirstValidPoint[k]:FirstValidPoint[k]+ActualPoints[k]].
+            ActualPoints = np.asarray(ActualPoints)
+            if ActualRecords != nrcds or len(ActualPoints) < nrcds or np.any(ActualPoints[:nrcds] < npts):
+                raise RuntimeError('Short fetch from {0}: {1} of {2} records with at least {3} of {4} points'.format(
+                                   channel, ActualRecords, nrcds, int(ActualPoints.min()) if ActualPoints.size else 0, npts))
+            Raw = np.asarray(OutArray, dtype=np.int16)
+            FirstValidPoint = np.asarray(FirstValidPoint, dtype=np.int64)[:nrcds]
+            step = int(FirstValidPoint[1] - FirstValidPoint[0]) if nrcds > 1 else npts
+            if (step > 0 and FirstValidPoint[0] >= 0 and FirstValidPoint[-1] + npts <= Raw.size
+                    and np.all(np.diff(FirstValidPoint) == step)):
+                # evenly spaced records (the normal case in TSR mode): copy a strided view of the buffer, without an index array
+                Records = np.lib.stride_tricks.as_strided(Raw[FirstValidPoint[0]:], shape=(nrcds, npts), strides=(step*Raw.strides[0], Raw.strides[0]))
+                np.copyto(out, Records)
+            else:
+                for k in range(nrcds):
+                    out[k] = Raw[FirstValidPoint[k]:FirstValidPoint[k]+npts]
+            InitialXOffset = InitialXOffset[0]
+        else:
+            for j in range(nrcds):
+                # This function returns the waveform the digitizer acquired for the specified channel in raw ADC units.
+                [OutArray, ActualPoints, FirstValidPoint, InitialXOffset, InitialXTimeSeconds, InitialXTimeFraction, XIncrement, ScaleFactor, ScaleOffset] = self.AgMD2.Channels(channel).Measurement.FetchWaveformInt16()
+                ##############################
+                # Outputs:
+                # OutArray:  Buffer into which the acquired waveform is stored.
+                # ActualPoints: Indicates how many data points were actually retrieved from the instrument.
+                # FirstValidPoint: Indicates the index of the first valid data point in the output data array.
+                # InitialXOffset: The time in relation to the Trigger Event of the first point in the waveform in seconds. Negative values mean that the first point in the waveform array was acquired before the trigger event.
+                # InitialXTimeSeconds: Specifies the seconds portion of the absolute time at which the first data point was acquired. Note that the actual time is the sum of InitialXTimeSeconds and InitialXTimeFraction.
+                # InitialXTimeFraction: Specifies the fractional portion of the absolute time at which the first data point was acquired. Note that the actual time is the sum of InitialXTimeSeconds and InitialXTimeFraction.
+                # XIncrement: The time between points in the acquired waveform in seconds.
+                # ScaleFactor: Scaling factor for the waveform data.
+                # ScaleOffset: Scaling offset for the waveform data.
+                out[j,:] = OutArray[FirstValidPoint:FirstValidPoint+ActualPoints]
+        return ScaleFactor, ScaleOffset, InitialXOffset, XIncrement
+        
+    def fetch_acquisition(self, Block=None):
+        """
+        Fetches both channels of the completed acquisition and releases its memory segment with continue_acquisition().
+        Parameters:
+            Block - AcquisitionBlock into which the records are fetched, None for a new one of
+                    NumRecordsPerAcquisition x RecordSize records
+        Returns:
+            the filled AcquisitionBlock
+        """
+        if Block is None:
+            shape = (self.NumRecordsPerAcquisition(), self.RecordSize())
+            Block = AcquisitionBlock(np.empty(shape, dtype=np.int16), np.empty(shape, dtype=np.int16))
+        nrcds, npts = Block.Codes1.shape
+        with self.timer.stage('fetch'):
+            [Block.ScaleFactor1, Block.ScaleOffset1, Block.InitialXOffset1, Block.XIncrement1] = self.fetch_records('Channel1', nrcds, npts, Block.Codes1)
+            [Block.ScaleFactor2, Block.ScaleOffset2, Block.InitialXOffset2, Block.XIncrement2] = self.fetch_records('Channel2', nrcds, npts, Block.Codes2)
+        with self.timer.stage('continue'):
+            self.continue_acquisition()      # the records are copied, so the memory segment can be released immediately
+        return Block
+    
     def continue_acquisition(self):
         if self.AcquisitionMode() == 'TSR': 
             self.AgMD2.Acquisition3.TSR.Continue() # Marks the acquired (single- or multi-record) waveform currently available for fetching as no longer needed (e.g. once it has been read). This allows the corresponding memory segment(s) to be released and made available for new acquisitions.
     
     def stop(self):
         if self.AcquisitionMode() == 'TSR': 
-            self.AgMD2.Acquisition3.abort()    # Aborts an acquisition and returns the digitizer to the Idle state.
+            with self.timer.stage('abort'):
+                self.AgMD2.Acquisition3.abort()    # Aborts an acquisition and returns the digitizer to the Idle state.
         
     def disconnect(self):
+        if self.__DriverCookie is not None:
+            import comtypes.git
+            comtypes.git.RevokeInterfaceFromGlobal(self.__DriverCookie)
+            self.__DriverCookie = None
         self.AgMD2.close()
         self.close()
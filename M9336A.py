@@ -2,20 +2,26 @@ from qcodes import (validators as vals)
 from qcodes.instrument.base import Instrument
 import qcodes as qc
 from qcodes.instrument.channel import InstrumentChannel
+from qcodes.instrument_drivers.Keysight.DriverCache import DriverValueCache
 
 import sys
-import clr
 import time
+import hashlib
+from collections import OrderedDict
 import numpy as np
 
 BIGINT = int(1e18)
 
-# load the driver wrapper (instead of the driver directly)
 path_to_driver ='C:\\Program Files\\Keysight\\MAwg\\bin'
-sys.path.append(path_to_driver)
-clr.AddReference("KtMAwgDriverWrapper")
 
-from KtMAwgWrapper import KtMAwgWrapper
+def load_KtMAwgWrapper():
+    # load the driver wrapper (instead of the driver directly), only done when a real M9336A is created
+    import clr
+    if path_to_driver not in sys.path:
+        sys.path.append(path_to_driver)
+    clr.AddReference("KtMAwgDriverWrapper")
+    from KtMAwgWrapper import KtMAwgWrapper
+    return KtMAwgWrapper
 
 class Keysight_M9336A_Channel(InstrumentChannel):
     """
@@ -40,6 +46,13 @@ class Keysight_M9336A_Channel(InstrumentChannel):
         if channel not in ['Channel1', 'Channel2', 'Channel3']:
             raise ValueError('channel must be either "Channel1" or "Channel2" or "Channel3"')
         
+        # For the waveform cache: waveforms already resident in the AWG memory, least recently used first
+        self._waveform_cache = OrderedDict()     # hash of waveform, markers and sample rate -> (handle, size in bytes)
+        self._waveform_cache_bytes = 0          # estimated AWG memory used by the cached waveforms
+        self._WaveformCacheSize = 512*2**20     # memory budget of the cache in bytes
+        self._configured_handle = None          # handle of the waveform configured by init_channel, never evicted
+        self.reset_WaveformCacheStatistics()
+        
         self.add_parameter('SampleRate',
                            label = 'AWG Sample Rate',
                            unit = 'Hz',
@@ -94,21 +107,33 @@ class Keysight_M9336A_Channel(InstrumentChannel):
                            set_cmd=self.set_BurstCount,
                            vals = vals.Ints(1,2**31 -1))
         
+        self.add_parameter('WaveformCacheSize',
+                           label = 'Memory budget of the waveform cache',
+                           unit = 'B',
+                           get_cmd=self.get_WaveformCacheSize,
+                           set_cmd=self.set_WaveformCacheSize,
+                           vals = vals.Ints(0,BIGINT))
+        
+        self.add_parameter('WaveformCacheStatistics',
+                           label = 'Hits, misses and evictions of the waveform cache',
+                           get_cmd=self.get_WaveformCacheStatistics,
+                           set_cmd=False)
+        
     
     def get_SampleRate(self):
-        return self._parent.driverw.Arbitrary.GetSampleRate(self._channel)
+        return self._parent.cached_get((self._channel, 'SampleRate'), lambda: self._parent.driverw.Arbitrary.GetSampleRate(self._channel))
     
     def set_SampleRate(self,value):
-        self._parent.driverw.Arbitrary.SetSampleRate(self._channel, value)
+        self._parent.cached_set((self._channel, 'SampleRate'), lambda: self._parent.driverw.Arbitrary.SetSampleRate(self._channel, value))
     
     def set_ChannelMode(self,value):
         if value == 'waveform':
-            self._parent.driverw.Output.SetChannelMode(self._channel, 0)
+            self._parent.cached_set((self._channel, 'ChannelMode'), lambda: self._parent.driverw.Output.SetChannelMode(self._channel, 0))
         elif value == 'marker':
-            self._parent.driverw.Output.SetChannelMode(self._channel, 1)
+            self._parent.cached_set((self._channel, 'ChannelMode'), lambda: self._parent.driverw.Output.SetChannelMode(self._channel, 1))
                 
     def get_ChannelMode(self):
-        value = self._parent.driverw.Output.GetChannelMode(self._channel)
+        value = self._parent.cached_get((self._channel, 'ChannelMode'), lambda: self._parent.driverw.Output.GetChannelMode(self._channel))
         if value == 0:
             return 'waveform'
         elif value == 1:
@@ -116,60 +141,119 @@ class Keysight_M9336A_Channel(InstrumentChannel):
         
     def set_OperationMode(self,value):
         if value == 'continuous':
-            self._parent.driverw.SetOperationMode(self._channel, 0)   # Sets the mode that determines how the AWG produces output for the specified channel when that channel is in Output Generation State.
+            self._parent.cached_set((self._channel, 'OperationMode'), lambda: self._parent.driverw.SetOperationMode(self._channel, 0))   # Sets the mode that determines how the AWG produces output for the specified channel when that channel is in Output Generation State.
         elif value == 'burst':
-            self._parent.driverw.SetOperationMode(self._channel, 1)   # Sets the mode that determines how the AWG produces output for the specified channel when that channel is in Output Generation State.
+            self._parent.cached_set((self._channel, 'OperationMode'), lambda: self._parent.driverw.SetOperationMode(self._channel, 1))   # Sets the mode that determines how the AWG produces output for the specified channel when that channel is in Output Generation State.
         
     def get_OperationMode(self):
-        value = self._parent.driverw.GetOperationMode(self._channel)
+        value = self._parent.cached_get((self._channel, 'OperationMode'), lambda: self._parent.driverw.GetOperationMode(self._channel))
         if value == 0:
             return 'continuous'
         elif value == 1:
             return 'burst'
  
     def get_BurstCount(self):
-        return self._parent.driverw.Trigger.Start.GetBurstCount(self._channel)
+        return self._parent.cached_get((self._channel, 'BurstCount'), lambda: self._parent.driverw.Trigger.Start.GetBurstCount(self._channel))
     
     def set_BurstCount(self,value):
-        self._parent.driverw.Trigger.Start.SetBurstCount(self._channel, value)
+        self._parent.cached_set((self._channel, 'BurstCount'), lambda: self._parent.driverw.Trigger.Start.SetBurstCount(self._channel, value))
         
     def set_TerminalConfiguration(self,value):
         if value == 'single-ended':
-            self._parent.driverw.Output.SetTerminalConfiguration(self._channel, 0)   # Determines whether the AWG will run in Single-ended Mode or Differential Mode. The Terminal Configuration determines how the gain and offset voltages will be processed.
+            self._parent.cached_set((self._channel, 'TerminalConfiguration'), lambda: self._parent.driverw.Output.SetTerminalConfiguration(self._channel, 0))   # Determines whether the AWG will run in Single-ended Mode or Differential Mode. The Terminal Configuration determines how the gain and offset voltages will be processed.
         elif value == 'differential':
-            self._parent.driverw.Output.SetTerminalConfiguration(self._channel, 1)   # Determines whether the AWG will run in Single-ended Mode or Differential Mode. The Terminal Configuration determines how the gain and offset voltages will be processed.
+            self._parent.cached_set((self._channel, 'TerminalConfiguration'), lambda: self._parent.driverw.Output.SetTerminalConfiguration(self._channel, 1))   # Determines whether the AWG will run in Single-ended Mode or Differential Mode. The Terminal Configuration determines how the gain and offset voltages will be processed.
         
     def get_TerminalConfiguration(self):
-        value = self._parent.driverw.Output.GetTerminalConfiguration(self._channel)
+        value = self._parent.cached_get((self._channel, 'TerminalConfiguration'), lambda: self._parent.driverw.Output.GetTerminalConfiguration(self._channel))
         if value == 0:
             return 'single-ended'
         elif value == 1:
             return 'differential'
             
     def set_Gain(self,value):
-        self._parent.driverw.Arbitrary.SetGain(self._channel, value)   # Sets the Composite Gain of the AWG, which the driver uses to set the Digital Gain and the Analog Gain. This value determines the fullscale output voltage.
+        self._parent.cached_set((self._channel, 'Gain'), lambda: self._parent.driverw.Arbitrary.SetGain(self._channel, value))   # Sets the Composite Gain of the AWG, which the driver uses to set the Digital Gain and the Analog Gain. This value determines the fullscale output voltage.
 
     def get_Gain(self):
-        return self._parent.driverw.Arbitrary.GetGain(self._channel)   # Gets the Composite Gain of the AWG, which the driver uses to set the Digital Gain and the Analog Gain. This value determines the full scale output voltage. 
+        return self._parent.cached_get((self._channel, 'Gain'), lambda: self._parent.driverw.Arbitrary.GetGain(self._channel))   # Gets the Composite Gain of the AWG, which the driver uses to set the Digital Gain and the Analog Gain. This value determines the full scale output voltage. 
     
     def set_Offset(self,value):
-        self._parent.driverw.Arbitrary.SetOffset(self._channel, value)   # Sets the offset voltage of the waveform the AWG produces. The units are volts.
+        self._parent.cached_set((self._channel, 'Offset'), lambda: self._parent.driverw.Arbitrary.SetOffset(self._channel, value))   # Sets the offset voltage of the waveform the AWG produces. The units are volts.
 
     def get_Offset(self):
-        return self._parent.driverw.Arbitrary.GetOffset(self._channel)   # Gets the offset voltage of the waveform the AWG produces. The units are volts.
+        return self._parent.cached_get((self._channel, 'Offset'), lambda: self._parent.driverw.Arbitrary.GetOffset(self._channel))   # Gets the offset voltage of the waveform the AWG produces. The units are volts.
 
     def set_CommonModeOffset(self,value):
-        self._parent.driverw.Arbitrary.SetCommonModeOffset(self._channel, value)   #Sets the common mode offset applied when the terminal configuration is set to differential. This is a DC voltage value and the units are volts.
+        self._parent.cached_set((self._channel, 'CommonModeOffset'), lambda: self._parent.driverw.Arbitrary.SetCommonModeOffset(self._channel, value))   #Sets the common mode offset applied when the terminal configuration is set to differential. This is a DC voltage value and the units are volts.
 
     def get_CommonModeOffset(self):
-        return self._parent.driverw.Arbitrary.GetCommonModeOffset(self._channel)     # Gets the common mode offset voltage applied when the terminal configuration is set to differential. This is a DC voltage value, and the units are volts.
+        return self._parent.cached_get((self._channel, 'CommonModeOffset'), lambda: self._parent.driverw.Arbitrary.GetCommonModeOffset(self._channel))     # Gets the common mode offset voltage applied when the terminal configuration is set to differential. This is a DC voltage value, and the units are volts.
+    
+    def get_WaveformCacheSize(self):
+        return self._WaveformCacheSize
+    
+    def set_WaveformCacheSize(self,value):
+        self._WaveformCacheSize = value
+        self._evict_waveforms()
+    
+    def get_WaveformCacheStatistics(self):
+        stats = dict(self._waveform_cache_stats)
+        stats['entries'] = len(self._waveform_cache)
+        stats['bytes'] = self._waveform_cache_bytes
+        return stats
+    
+    def reset_WaveformCacheStatistics(self):
+        self._waveform_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
     
     def load_waveform(self, WaveformName, WaveformArray, MarkerArray):
+        # Waveforms with the same samples, markers and sample rate as a cached one reuse its handle instead of being uploaded again
+        key = self._waveform_key(WaveformArray, MarkerArray)
+        if key in self._waveform_cache:
+            self._waveform_cache.move_to_end(key)
+            self._waveform_handle = self._waveform_cache[key][0]
+            self._waveform_cache_stats['hits'] += 1
+            return
         # Creates a channel-specific waveform segment and returns a handle that identifies the waveform segment. The waveform samples are in a double-precision floating point array. An optional array of marker bytes can be provided.
         self._waveform_handle = self._parent.driverw.Arbitrary.Waveform.CreateChannelWaveform(self._channel, WaveformName, WaveformArray, MarkerArray)
+        self._waveform_cache_stats['misses'] += 1
+        size = 3*np.size(WaveformArray)     # 16-bit sample and marker byte per point in the AWG memory
+        self._waveform_cache[key] = (self._waveform_handle, size)
+        self._waveform_cache_bytes += size
+        self._evict_waveforms()
+    
+    def _waveform_key(self, WaveformArray, MarkerArray):
+        WaveformArray = np.ascontiguousarray(WaveformArray, dtype=np.float64)
+        MarkerArray = np.ascontiguousarray(MarkerArray)
+        h = hashlib.sha1()
+        h.update(WaveformArray.data)
+        h.update(MarkerArray.dtype.str.encode())
+        h.update(MarkerArray.data)
+        h.update(repr(self.SampleRate()).encode())
+        return h.hexdigest()
+    
+    def _evict_waveforms(self):
+        # Clears the least recently used waveforms from the AWG memory until the cache fits into its budget
+        for key in list(self._waveform_cache):
+            if self._waveform_cache_bytes <= self._WaveformCacheSize:
+                break
+            handle, size = self._waveform_cache[key]
+            if handle is self._waveform_handle or handle is self._configured_handle:
+                continue
+            self._parent.driverw.Arbitrary.Waveform.Clear(handle[0])
+            del self._waveform_cache[key]
+            self._waveform_cache_bytes -= size
+            self._waveform_cache_stats['evictions'] += 1
+    
+    def clear_waveform_cache(self):
+        """ clears all cached waveforms except the loaded and the configured one from the AWG memory """
+        budget = self._WaveformCacheSize
+        self._WaveformCacheSize = 0
+        self._evict_waveforms()
+        self._WaveformCacheSize = budget
     
     def init_channel(self):    
         self._parent.driverw.Arbitrary.Configure(self._channel, self._waveform_handle[0], self.Gain(), self.Offset(), self.CommonModeOffset())  #Configures the attributes of the AWG that affect sequence generation.
+        self._configured_handle = self._waveform_handle
     
     def enable(self):
         self._parent.driverw.Output.SetEnabled(self._channel, True)   # If true, causes the waveform produced by the AWG to appear at the output connector for the specified channel.
@@ -193,19 +277,35 @@ class Keysight_M9336A_Channel(InstrumentChannel):
     def abort_generation(self):
         self._parent.driverw.AbortGeneration(self._channel)      # If the AWG is in the Output Generation State, this method moves the AWG to the Configuration State for the specified channel or channels.
 
-class M9336A(Instrument):
+class M9336A(DriverValueCache, Instrument):
     """ 
     Driver for the AWG of the Keysight M9336A card.
-    
+    The vendor driver is only loaded when the instrument is created.
+    Parameters:
+        backend - 'real' for the KtMAwgWrapper driver, 'emulated' for KtMAwgEmulator.EmulatedKtMAwg
+        driver - object implementing the KtMAwgWrapper interface which is used instead of the backend, e.g. a configured EmulatedKtMAwg
     """
-    def __init__(self, name, address, **kwargs):
+    def __init__(self, name, address, backend='real', driver=None, **kwargs):
         super().__init__(name, **kwargs)
         
-        self.driverw = KtMAwgWrapper()
+        if backend not in ('real', 'emulated'):
+            raise ValueError('backend must be either "real" or "emulated"')
+        self.backend = backend
+        
+        if driver is not None:
+            self.driverw = driver
+        elif backend == 'emulated':
+            from qcodes.instrument_drivers.Keysight.KtMAwgEmulator import EmulatedKtMAwg
+            self.driverw = EmulatedKtMAwg()
+        else:
+            self.driverw = load_KtMAwgWrapper()()
 
 
         self.driverw.Initialize(address, '')
         
+        # For the driver value cache, keys are (channel, attribute)
+        self.init_driver_cache()
+        
         print('*********************')
         print('Zoidberg2 AWG Specs:') 
         print('M9336A-B50 Channel Bandwidth, 540 MHz')
@@ -226,13 +326,26 @@ class M9336A(Instrument):
              self.add_submodule(ch_name, channel)
        
     
-    def generate_MarkersArray(self, marker_gate, marker_acq_ext, marker_acq_int):
-        # build temporary arrays for the final binary marker mask
-        # bit position = destination bit position - 16
-        _marker_gate = (2**0)*np.array(marker_gate)
-        _marker_acq_ext = (2**1)*np.array(marker_acq_ext)
-        _marker_acq_int = (2**2)*np.array(marker_acq_int)
-        return np.sum([_marker_gate,_marker_acq_ext,_marker_acq_int], axis=0)
+    def generate_MarkersArray(self, *markers, length=None):
+        """
+        Packs marker lanes into a uint8 bitmask, e.g. generate_MarkersArray(marker_gate, marker_acq_ext, marker_acq_int).
+        Lane n sets bit n (bit position = destination bit position - 16) wherever it is non-zero.
+        Lanes of different length are padded with zeros to the longest lane or to length, e.g. length=len(waveform).
+        """
+        if len(markers) > 8:
+            raise ValueError('at most 8 marker lanes fit into the marker byte')
+        markers = [np.ravel(marker) for marker in markers]
+        if length is None:
+            length = max([len(marker) for marker in markers], default=0)
+        MarkersArray = np.zeros(length, dtype=np.uint8)
+        bit = np.empty(length, dtype=np.bool_)
+        shifted = np.empty(length, dtype=np.uint8)
+        for position, marker in enumerate(markers):
+            n = min(len(marker), length)
+            np.not_equal(marker[:n], 0, out=bit[:n])
+            np.left_shift(bit[:n].view(np.uint8), position, out=shifted[:n])
+            np.bitwise_or(MarkersArray[:n], shifted[:n], out=MarkersArray[:n])
+        return MarkersArray
     
     def initiate_generation(self,string):
         self.driverw.InitiateGeneration(string)
@@ -1,5 +1,14 @@
 # Import numpy
 import numpy as np  
+import json
+
+# binary waveform files: magic, header length (uint64), JSON header, arrays aligned to WAVEFORM_FILE_ALIGNMENT bytes
+WAVEFORM_FILE_MAGIC = b'\x93WFMBIN1'
+WAVEFORM_FILE_ALIGNMENT = 64
+
+def _aligned(nbytes):
+    # rounds nbytes up to the next multiple of WAVEFORM_FILE_ALIGNMENT
+    return -(-nbytes//WAVEFORM_FILE_ALIGNMENT)*WAVEFORM_FILE_ALIGNMENT
 
 class WaveformGenerator:
     """
@@ -20,9 +29,8 @@ class WaveformGenerator:
         return data
 
     def combine(*args):
-        data = [] # define data array
-        for arg in args:
-            data = np.append(data, arg)
+        # one concatenation instead of growing the array segment by segment
+        data = np.concatenate([np.zeros(0)] + [np.ravel(arg) for arg in args])
         return data
     
     def time(data, SR):
@@ -37,14 +45,266 @@ class WaveformGenerator:
         data = np.loadtxt(filename)
         return data
     
-    def length_correction(waveform, marker1, marker2):
-        data1 = np.append(waveform,np.zeros(max(len(waveform),len(marker1),len(marker2))-len(waveform)))
-        data2 = np.append(marker1,np.zeros(max(len(waveform),len(marker1),len(marker2))-len(marker1)))
-        data3 = np.append(marker2,np.zeros(max(len(waveform),len(marker1),len(marker2))-len(marker2)))
-        return data1, data2, data3
+    def save_waveform_binary(filename, data, markers=None, sample_rate=None, metadata=None):
+        """
+        Saves a waveform, its markers, the sample rate and metadata to one binary file which load_waveform_binary can memory-map.
+        Parameters:
+            filename - name of the file
+            data - waveform array
+            markers - marker array (e.g. a uint8 bitmask or marker lanes), None if there are no markers
+            sample_rate - sample rate in Hz
+            metadata - dict of JSON serializable sequence parameters
+        """
+        arrays = {'waveform': np.ascontiguousarray(data)}
+        if markers is not None:
+            arrays['markers'] = np.ascontiguousarray(markers)
+        header = {'sample_rate': sample_rate, 'metadata': metadata or {}, 'arrays': {}}
+        offset = 0      # offsets are relative to the start of the data section
+        for name, array in arrays.items():
+            header['arrays'][name] = {'dtype': array.dtype.str, 'shape': array.shape, 'offset': offset}
+            offset += _aligned(array.nbytes)
+        header_bytes = json.dumps(header).encode()
+        data_start = _aligned(len(WAVEFORM_FILE_MAGIC) + 8 + len(header_bytes))
+        with open(filename, 'wb') as f:
+            f.write(WAVEFORM_FILE_MAGIC)
+            f.write(np.uint64(len(header_bytes)).tobytes())
+            f.write(header_bytes)
+            for name, array in arrays.items():
+                f.write(bytes(data_start + header['arrays'][name]['offset'] - f.tell()))     # alignment padding
+                f.write(array.data)
+        print('Saved waveform data to file ',filename)
+    
+    def load_waveform_binary(filename, mmap_mode='r'):
+        """
+        Loads a file written by save_waveform_binary.
+        Parameters:
+            filename - name of the file
+            mmap_mode - mode of the memory map ('r', 'r+' or 'c'), None reads the arrays into memory
+        Returns:
+            data, markers, sample_rate, metadata - markers is None if the file has no markers
+        """
+        with open(filename, 'rb') as f:
+            if f.read(len(WAVEFORM_FILE_MAGIC)) != WAVEFORM_FILE_MAGIC:
+                raise ValueError('{0} is not a binary waveform file'.format(filename))
+            header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_length).decode())
+            data_start = _aligned(len(WAVEFORM_FILE_MAGIC) + 8 + header_length)
+            arrays = {}
+            for name, info in header['arrays'].items():
+                dtype, shape = np.dtype(info['dtype']), tuple(info['shape'])
+                if mmap_mode is None or np.prod(shape) == 0:
+                    f.seek(data_start + info['offset'])
+                    arrays[name] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+                else:
+                    arrays[name] = np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=data_start + info['offset'], shape=shape)
+        return arrays['waveform'], arrays.get('markers'), header['sample_rate'], header['metadata']
+    
+    def length_correction(waveform, *markers):
+        # pads the waveform and any number of markers with zeros to a common length, one allocation for all of them
+        # (the markers can also be packed and padded to len(waveform) in one step by M9336A.generate_MarkersArray)
+        arrays = [np.ravel(waveform)] + [np.ravel(marker) for marker in markers]
+        data = np.zeros((len(arrays), max(len(array) for array in arrays)))
+        for row, array in zip(data, arrays):
+            row[:len(array)] = array
+        return tuple(data)
+
+    
+    
+        
+        
+        
+
+class WaveformBuilder:
+    """
+    Builds a waveform and its marker lanes from a list of segments in linear time.
+    pulse(), delay(), sine() and data() only collect the segments, build() computes the total length once
+    and fills the waveform and the marker lanes into one preallocated buffer.
+    Parameters:
+        sample_rate - sample rate in Hz
+        number_of_markers - number of marker lanes
+    Example:
+        waveform, markers = WaveformBuilder(SR, 3).delay(1e-6).pulse(1, 100e-9, markers=(0,2)).delay(10e-6).build()
+    """
+    def __init__(self, sample_rate, number_of_markers=0):
+        self.sample_rate = sample_rate
+        self.number_of_markers = number_of_markers
+        self.segments = []      # (kind, number of points, parameters, marker lanes which are high during the segment)
+    
+    def _add(self, kind, number_of_points, parameters, markers):
+        for lane in markers:
+            if not 0 <= lane < self.number_of_markers:
+                raise ValueError('marker lane {0} does not exist, the builder has {1} marker lanes'.format(lane, self.number_of_markers))
+        self.segments.append((kind, number_of_points, parameters, tuple(markers)))
+        return self
+    
+    def pulse(self, amplitude, duration, markers=()):
+        return self._add('pulse', int(round(duration*self.sample_rate)), amplitude, markers)
+    
+    def delay(self, duration, markers=()):
+        return self._add('pulse', int(round(duration*self.sample_rate)), 0.0, markers)
+    
+    def sine(self, amplitude, frequency, duration, dc_offset=0.0, markers=()):
+        return self._add('sine', int(round(duration*self.sample_rate)), (amplitude, frequency, dc_offset), markers)
+    
+    def data(self, array, markers=()):
+        array = np.ravel(array)
+        return self._add('data', len(array), array, markers)
+    
+    def __len__(self):
+        return sum(segment[1] for segment in self.segments)
+    
+    def build(self):
+        """
+        Returns the waveform and the marker lanes as an array of shape (number_of_markers, number_of_points).
+        Both are views on the same buffer.
+        """
+        buffer = np.empty((1 + self.number_of_markers, len(self)))
+        waveform, markers = buffer[0], buffer[1:]
+        markers[:] = 0
+        start = 0
+        for kind, number_of_points, parameters, lanes in self.segments:
+            stop = start + number_of_points
+            if kind == 'pulse':
+                waveform[start:stop] = parameters
+            elif kind == 'sine':
+                amplitude, frequency, dc_offset = parameters
+                np.multiply(np.arange(number_of_points), 2*np.pi*frequency/self.sample_rate, out=waveform[start:stop])
+                np.sin(waveform[start:stop], out=waveform[start:stop])
+                waveform[start:stop] *= amplitude
+                waveform[start:stop] += dc_offset
+            else:
+                waveform[start:stop] = parameters
+            for lane in lanes:
+                markers[lane, start:stop] = 1
+            start = stop
+        return waveform, markers
 
+
+class PulseSequence:
+    """
+    Declarative description of a pulse sequence: named pulses, delays and sine segments and the marker gates
+    anchored to them on one shared timeline.
+    render() returns the waveform and a uint8 marker bitmask (bit n = marker gate n) of the same length.
+    Identical sine segments are computed only once, and after a change only the part of the sequence
+    from the first changed segment on is rendered again.
+    Parameters:
+        sample_rate - sample rate in Hz
+    Example:
+        seq = PulseSequence(SR)
+        seq.delay('wait', 1e-6).pulse('pi2', 1, 50e-9).delay('tau', 10e-6).pulse('pi', 1, 100e-9).delay('echo', 20e-6)
+        seq.gate(0, 'pi2', 'pi', pre=20e-9)    # bit 0 is high from 20 ns before pi2 to the end of pi
+        seq.gate(2, 'echo')                    # bit 2 is high during echo
+        waveform, markers = seq.render()
+        seq.set('tau', duration=20e-6)         # the next render() starts at tau
+    """
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self._names = []        # segment names in time order
+        self._segments = {}     # name -> (kind, number of points, parameters)
+        self._gates = []        # (bit, first segment, last segment, points before, points after)
+        self._memo = {}         # rendered sine segments
+        self._last = None       # (segments, gates, waveform, markers) of the last render
+    
+    def _points(self, duration):
+        return int(round(duration*self.sample_rate))
     
+    def _add(self, name, segment):
+        if name in self._segments:
+            raise ValueError('segment {0} already exists'.format(name))
+        self._names.append(name)
+        self._segments[name] = segment
+        return self
     
+    def pulse(self, name, amplitude, duration):
+        return self._add(name, ('pulse', self._points(duration), amplitude))
+    
+    def delay(self, name, duration):
+        return self._add(name, ('pulse', self._points(duration), 0.0))
+    
+    def sine(self, name, amplitude, frequency, duration, dc_offset=0.0):
+        return self._add(name, ('sine', self._points(duration), (amplitude, frequency, dc_offset)))
+    
+    def gate(self, bit, first, last=None, pre=0.0, post=0.0):
+        """
+        Adds a marker gate which is high from pre seconds before the start of segment first
+        to post seconds after the end of segment last (default first).
+        """
+        last = first if last is None else last
+        if not 0 <= bit < 8:
+            raise ValueError('marker bit must be between 0 and 7')
+        for name in (first, last):
+            if name not in self._segments:
+                raise ValueError('segment {0} does not exist'.format(name))
+        if self._names.index(last) < self._names.index(first):
+            raise ValueError('segment {0} is before segment {1}'.format(last, first))
+        self._gates.append((bit, first, last, self._points(pre), self._points(post)))
+        return self
+    
+    def set(self, name, duration=None, amplitude=None, frequency=None, dc_offset=None):
+        """ changes the duration or the parameters of a segment """
+        kind, number_of_points, parameters = self._segments[name]
+        if duration is not None:
+            number_of_points = self._points(duration)
+        if kind == 'pulse':
+            if frequency is not None or dc_offset is not None:
+                raise ValueError('segment {0} is not a sine'.format(name))
+            if amplitude is not None:
+                parameters = amplitude
+        else:
+            parameters = tuple(old if new is None else new for old, new in zip(parameters, (amplitude, frequency, dc_offset)))
+        self._segments[name] = (kind, number_of_points, parameters)
+        return self
+    
+    def __len__(self):
+        return sum(self._segments[name][1] for name in self._names)
+    
+    def render(self):
+        """
+        Returns the waveform (float64) and the marker bitmask (uint8) of the sequence.
+        Every render() returns new arrays, but copies the unchanged segments from the arrays of the previous render(),
+        so the returned arrays must not be modified in place.
+        """
+        segments = [self._segments[name] for name in self._names]
+        index = {name: k for k, name in enumerate(self._names)}
+        starts = np.cumsum([0] + [segment[1] for segment in segments])
+        total = int(starts[-1])
+        waveform = np.empty(total)
+        markers = np.empty(total, dtype=np.uint8)
+        
+        # everything before the first changed segment is copied from the last render
+        first = 0
+        mfirst = 0
+        if self._last is not None:
+            last_segments, last_gates, last_waveform, last_markers = self._last
+            while first < min(len(segments), len(last_segments)) and segments[first] == last_segments[first]:
+                first += 1
+            waveform[:starts[first]] = last_waveform[:starts[first]]
+            if self._gates == last_gates:
+                # gates anchored after the first changed segment reach back at most by their pre points
+                mfirst = max(0, starts[first] - max([gate[3] for gate in self._gates], default=0))
+                markers[:mfirst] = last_markers[:mfirst]
+        
+        for kind, number_of_points, parameters in segments[first:]:
+            start = starts[first]
+            stop = start + number_of_points
+            if kind == 'pulse':
+                waveform[start:stop] = parameters
+            else:
+                key = (number_of_points, parameters)
+                if key not in self._memo:
+                    amplitude, frequency, dc_offset = parameters
+                    self._memo[key] = dc_offset + amplitude*np.sin(2*np.pi*frequency/self.sample_rate*np.arange(number_of_points))
+                waveform[start:stop] = self._memo[key]
+            first += 1
         
+        markers[mfirst:] = 0
+        for bit, first_name, last_name, pre, post in self._gates:
+            start = max(starts[index[first_name]] - pre, mfirst)
+            stop = min(starts[index[last_name]+1] + post, total)
+            if stop > start:
+                markers[start:stop] |= np.uint8(1 << bit)
         
-        
\ No newline at end of file
+        # keep only the sine segments of the current sequence
+        self._memo = {(segment[1], segment[2]): self._memo[(segment[1], segment[2])] for segment in segments if segment[0] == 'sine'}
+        self._last = (segments, list(self._gates), waveform, markers)
+        return waveform, markers
\ No newline at end of file
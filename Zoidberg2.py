@@ -1,12 +1,19 @@
+import asyncio
+import logging
+import threading
 import numpy as np
 from time import time, sleep
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from qcodes import (Instrument, MultiParameter, validators as vals)
 from qcodes.instrument_drivers.Keysight.M9336A import M9336A
-from qcodes.instrument_drivers.Keysight.M9203A import M9203A
+from qcodes.instrument_drivers.Keysight.M9203A import M9203A, Reducer, MeanTrace, WindowIntegral, IQHistogram, PowerSpectrum, RawSink
 
 BIGINT = int(1e18)
 
+log = logging.getLogger(__name__)
+
 class IQArray_raw(MultiParameter):
     """
     MultiParameter class for IQ data
@@ -36,65 +43,146 @@ class IQArray_raw(MultiParameter):
 
         
     def get_raw(self):
-        self._instrument.dig.start() # Initiates a waveform acquisition. The digitizer waits for a trigger.
+        return self._instrument.measure(RawSink(), name='IQArray_raw')[0]
+
+class IQArray_raw_int16(MultiParameter):
+    """
+    MultiParameter class for IQ data in raw ADC units
+    Records are kept as the native int16 ADC codes together with (ScaleFactor, ScaleOffset) of each channel,
+    use ScaledRecords to convert them to volts when needed.
+    Parameters:
+        nacqs - number of acquisitions
+        nrcds - number of records per one acquisition
+        npts - number of points
+    """
+    def __init__(self, name, instrument, nacqs, nrcds, npts):
+        super().__init__(name,
+                         names=('I_codes','Q_codes','I_scale','Q_scale','I_time','Q_time'),
+                         shapes=((), (), (), (), (), ()),
+                         labels=('I_out', 'Q_out','I_scale','Q_scale','I_time', 'Q_time'),
+                         units=('ADC', 'ADC','','','s','s'))                        
+        
+        # Read instrument parameters
+        self._instrument = instrument
+        
+        # Set shapes
+        self.update_shapes(nacqs, nrcds, npts)
+        
+        self.setpoint_names = (('I_raw_nrcds','I_raw_npts'), ('Q_raw_nrcds','Q_raw_npts'), ('I_scale_index',), ('Q_scale_index',), ('TimeI_raw_npts',), ('TimeQ_raw_npts',))
+
+    def update_shapes(self,nacqs, nrcds, npts):
+        self.shapes = ((nacqs*nrcds,npts), (nacqs*nrcds,npts),(2,),(2,),(npts,),(npts,))
+
+    def get_raw(self):
+        return self._instrument.measure(RawSink(scaled=False), name='IQArray_raw_int16')[0]
+
+class DigitalDownConverter:
+    """
+    Digital down-conversion of digitizer records to complex baseband.
+    The records are mixed with a cached NCO table exp(-2*pi*i*frequency*t), low-pass filtered by averaging
+    over blocks of `decimation` samples (integrate and dump) and decimated by the same factor, in a single pass.
+    Samples beyond the last full block are dropped.
+    Parameters:
+        frequency - intermediate frequency in Hz
+        decimation - decimation factor
+    """
+    def __init__(self, frequency, decimation):
+        self.frequency = frequency
+        self.decimation = int(decimation)
+        self._nco_key = None
+    
+    def nco(self, npts, InitialXOffset, XIncrement):
+        """ returns the NCO table of shape (npts//decimation, decimation), divided by decimation """
+        key = (npts, InitialXOffset, XIncrement)
+        if key != self._nco_key:
+            n = (npts//self.decimation)*self.decimation
+            t = InitialXOffset + XIncrement*np.arange(n)
+            self._nco = (np.exp(-2j*np.pi*self.frequency*t)/self.decimation).reshape(-1, self.decimation)
+            self._nco_sum = self._nco.sum(axis=1)     # response to the constant ScaleOffset
+            self._nco_key = key
+        return self._nco
+    
+    def time(self, npts, InitialXOffset, XIncrement):
+        """ returns the time of the centre of each decimated sample """
+        nblocks = npts//self.decimation
+        return InitialXOffset + XIncrement*(self.decimation*np.arange(nblocks) + (self.decimation-1)/2)
+    
+    def process(self, Codes, ScaleFactor, ScaleOffset, InitialXOffset, XIncrement, out=None):
+        """
+        Converts int16 records of shape (nrcds, npts) to complex baseband records of shape (nrcds, npts//decimation) in volts.
+        """
+        nrcds, npts = Codes.shape
+        nco = self.nco(npts, InitialXOffset, XIncrement)
+        nblocks = nco.shape[0]
+        Blocks = Codes[:, :nblocks*self.decimation].reshape(nrcds, nblocks, self.decimation)
+        Baseband = np.einsum('rkd,kd->rk', Blocks, nco)
+        Baseband *= ScaleFactor
+        Baseband += ScaleOffset*self._nco_sum
+        if out is None:
+            return Baseband
+        out[...] = Baseband
+        return out
+
+class Demodulated(Reducer):
+    """
+    Reducer which converts every record of both channels to complex baseband with a DigitalDownConverter while fetching.
+    Result: (I baseband, Q baseband, TimeI, TimeQ) of shape (nacqs*nrcds, npts//decimation)
+    """
+    def __init__(self, ddc):
+        self.ddc = ddc
+    
+    def prepare(self, digitizer, nacqs, nrcds, npts):
+        super().prepare(digitizer, nacqs, nrcds, npts)
+        self.npts = npts
+        nblocks = npts//self.ddc.decimation
+        self.Out1, self.Out2 = digitizer.allocate_records(('I_baseband', 'Q_baseband'), (nacqs*nrcds,nblocks), np.complex64)
+    
+    def add(self, Block):
+        # down-convert the ADC codes straight into the output arrays
+        nrcds = Block.Codes1.shape[0]
+        rows = slice(Block.index*nrcds, (Block.index+1)*nrcds)
+        with self.timer.stage('accumulate'):
+            self.ddc.process(Block.Codes1, Block.ScaleFactor1, Block.ScaleOffset1, Block.InitialXOffset1, Block.XIncrement1, out=self.Out1[rows])
+            self.ddc.process(Block.Codes2, Block.ScaleFactor2, Block.ScaleOffset2, Block.InitialXOffset2, Block.XIncrement2, out=self.Out2[rows])
+    
+    def result(self, Block):
+        nblocks = self.npts//self.ddc.decimation
+        if Block is None:
+            return self.Out1, self.Out2, np.zeros((nblocks,)), np.zeros((nblocks,))
+        Time1 = self.ddc.time(self.npts, Block.InitialXOffset1, Block.XIncrement1)
+        Time2 = self.ddc.time(self.npts, Block.InitialXOffset2, Block.XIncrement2)
+        return self.Out1, self.Out2, Time1, Time2
+
+class IQArray_demodulated(MultiParameter):
+    """
+    MultiParameter class for down-converted IQ data
+    Every record of both channels is converted to complex baseband with the DigitalDownConverter of the instrument while fetching.
+    Parameters:
+        nacqs - number of acquisitions
+        nrcds - number of records per one acquisition
+        npts - number of points
+    """
+    def __init__(self, name, instrument, nacqs, nrcds, npts):
+        super().__init__(name,
+                         names=('I_baseband','Q_baseband','I_time','Q_time'),
+                         shapes=((), (), (), ()),
+                         labels=('I_baseband', 'Q_baseband','I_time', 'Q_time'),
+                         units=('V', 'V','s','s'))                        
+        
+        # Read instrument parameters
+        self._instrument = instrument
         
-        # initiate AWG generation
-        self._instrument.awg.initiate_generation('Channel1,Channel2')
+        # Set shapes
+        self.update_shapes(nacqs, nrcds, npts)
+        
+        self.setpoint_names = (('I_bb_nrcds','I_bb_npts'), ('Q_bb_nrcds','Q_bb_npts'), ('TimeI_bb_npts',), ('TimeQ_bb_npts',))
 
-        # update nacqs, nrcds and npts values
-        self.__nacqs = self._instrument.dig.NumberOfAcquisitions()
-        self.__nrcds = self._instrument.dig.NumRecordsPerAcquisition()
-        self.__npts = self._instrument.dig.RecordSize()
-        
-        # define output data arrays
-        OutVoltageArrays1 = np.zeros((self.__nacqs*self.__nrcds,self.__npts))
-        OutVoltageArrays2 = np.zeros((self.__nacqs*self.__nrcds,self.__npts))
-        Time1 = np.zeros((1,self.__npts))
-        Time2 = np.zeros((1,self.__npts))
-        
-        # fetch data
-        print('Fetching data...')
-        print('Number of Acquisitions: ',self.__nacqs)
-        print('Number of Records Per Acquisition: ',self.__nrcds)
-        start_time = time() # get time stamp
-        for i in range(self.__nacqs):
-            NoErrorCheck = self._instrument.dig.WaitUntilAcqComplete() # Indicates if a (single- or multi-record) waveform can be fetched from the instrument.
-            if NoErrorCheck == False: 
-                break 
-            for j in range(self.__nrcds):
-                # This function returns the waveform the digitizer acquired for the specified channel in raw ADC units.
-                [__OutArray1, __ActualPoints1, __FirstValidPoint1, __InitialXOffset1, __InitialXTimeSeconds1, __InitialXTimeFraction1, __XIncrement1, __ScaleFactor1, __ScaleOffset1] = self._instrument.dig.AgMD2.Channels('Channel1').Measurement.FetchWaveformInt16()
-                [__OutArray2, __ActualPoints2, __FirstValidPoint2, __InitialXOffset2, __InitialXTimeSeconds2, __InitialXTimeFraction2, __XIncrement2, __ScaleFactor2, __ScaleOffset2] = self._instrument.dig.AgMD2.Channels('Channel2').Measurement.FetchWaveformInt16()
-                ##############################
-                # Outputs:
-                # OutArray:  Buffer into which the acquired waveform is stored.
-                # ActualPoints: Indicates how many data points were actually retrieved from the instrument.
-                # FirstValidPoint: Indicates the index of the first valid data point in the output data array.
-                # InitialXOffset: The time in relation to the Trigger Event of the first point in the waveform in seconds. Negative values mean that the first point in the waveform array was acquired before the trigger event.
-                # InitialXTimeSeconds: Specifies the seconds portion of the absolute time at which the first data point was acquired. Note that the actual time is the sum of InitialXTimeSeconds and InitialXTimeFraction.
-                # InitialXTimeFraction: Specifies the fractional portion of the absolute time at which the first data point was acquired. Note that the actual time is the sum of InitialXTimeSeconds and InitialXTimeFraction.
-                # XIncrement: The time between points in the acquired waveform in seconds.
-                # ScaleFactor: Scaling factor for the waveform data.
-                # ScaleOffset: Scaling offset for the waveform data.
-                VoltageArray1 = __ScaleOffset1 + np.multiply(__OutArray1[__FirstValidPoint1:__FirstValidPoint1+__ActualPoints1],__ScaleFactor1)
-                VoltageArray2 = __ScaleOffset2 + np.multiply(__OutArray2[__FirstValidPoint2:__FirstValidPoint2+__ActualPoints2],__ScaleFactor2)
-                OutVoltageArrays1[i*self.__nrcds+j,:] = VoltageArray1
-                OutVoltageArrays2[i*self.__nrcds+j,:] = VoltageArray2
-            self._instrument.dig.continue_acquisition() 
+    def update_shapes(self,nacqs, nrcds, npts):
+        nblocks = npts//self._instrument.DecimationFactor()
+        self.shapes = ((nacqs*nrcds,nblocks), (nacqs*nrcds,nblocks),(nblocks,),(nblocks,))
 
-        if NoErrorCheck == True:
-            # To optimize the memory size, keep only single array of time data for each channel
-            Time1 = np.linspace(__InitialXOffset1,__InitialXOffset1+__ActualPoints1*__XIncrement1,__ActualPoints1)
-            Time2 = np.linspace(__InitialXOffset2,__InitialXOffset2+__ActualPoints2*__XIncrement2,__ActualPoints2)
-            self._instrument.dig.stop() # stop acquisition
-            self._instrument.awg.ch1.abort_generation() # abort generation            
-            self._instrument.awg.ch2.abort_generation() # abort generation           
-         
-        
-        print('get() of "IQArray_raw" was executed in {0} s'.format(time()-start_time))
-        print('')
-        print('If running QCoDes Measure() or Loop() function: Waiting for QCoDes to write the data to a file.')
-        return OutVoltageArrays1, OutVoltageArrays2, Time1, Time2
+    def get_raw(self):
+        return self._instrument.measure(Demodulated(self._instrument.ddc), name='IQArray_demodulated')[0]
 
 class IQArray_averaged(MultiParameter):
     """
@@ -122,72 +210,7 @@ class IQArray_averaged(MultiParameter):
 
         
     def get_raw(self):
-        self._instrument.dig.start()                  # Initiates a waveform acquisition. The digitizer waits for a trigger.
-        
-        # initiate AWG generation
-        self._instrument.awg.initiate_generation('Channel1,Channel2')
-                
-        # update nacqs, nrcds and npts values
-        self.__nacqs = self._instrument.dig.NumberOfAcquisitions()
-        self.__nrcds = self._instrument.dig.NumRecordsPerAcquisition()
-        self.__npts = self._instrument.dig.RecordSize()
-             
-        # fetch data
-        print('Fetching data...')
-        print('Number of Acquisitions: ', self.__nacqs)
-        print('Number of Records Per Acquisition: ', self.__nrcds)
-        print('**Number of Averages (= NumberOfAcquisitions x NumberOfRecordsPerAcquisition): ', self.__nacqs*self.__nrcds,'**')
-        
-        start_time = time() # get time stamp
-        
-        # define output data arrays
-        OutVoltageArrays1i = np.zeros((self.__npts,))
-        OutVoltageArrays2i = np.zeros((self.__npts,))
-        Time1 = np.zeros((self.__npts,))
-        Time2 = np.zeros((self.__npts,))
-        
-        for i in range(self.__nacqs):
-            OutVoltageArrays1j = np.zeros((self.__npts,))    # initialize a temporary array for averaging
-            OutVoltageArrays2j = np.zeros((self.__npts,))    # initialize a temporary array for averaging
-            NoErrorCheck = self._instrument.dig.WaitUntilAcqComplete() # Indicates if a (single- or multi-record) waveform can be fetched from the instrument.
-            if NoErrorCheck == False: 
-                break
-            for j in range(self.__nrcds):
-                # This function returns the waveform the digitizer acquired for the specified channel in raw ADC units.
-                [__OutArray1, __ActualPoints1, __FirstValidPoint1, __InitialXOffset1, __InitialXTimeSeconds1, __InitialXTimeFraction1, __XIncrement1, __ScaleFactor1, __ScaleOffset1] = self._instrument.dig.AgMD2.Channels('Channel1').Measurement.FetchWaveformInt16()
-                [__OutArray2, __ActualPoints2, __FirstValidPoint2, __InitialXOffset2, __InitialXTimeSeconds2, __InitialXTimeFraction2, __XIncrement2, __ScaleFactor2, __ScaleOffset2] = self._instrument.dig.AgMD2.Channels('Channel2').Measurement.FetchWaveformInt16()
-                ##############################
-                # Outputs:
-                # OutArray:  Buffer into which the acquired waveform is stored.
-                # ActualPoints: Indicates how many data points were actually retrieved from the instrument.
-                # FirstValidPoint: Indicates the index of the first valid data point in the output data array.
-                # InitialXOffset: The time in relation to the Trigger Event of the first point in the waveform in seconds. Negative values mean that the first point in the waveform array was acquired before the trigger event.
-                # InitialXTimeSeconds: Specifies the seconds portion of the absolute time at which the first data point was acquired. Note that the actual time is the sum of InitialXTimeSeconds and InitialXTimeFraction.
-                # InitialXTimeFraction: Specifies the fractional portion of the absolute time at which the first data point was acquired. Note that the actual time is the sum of InitialXTimeSeconds and InitialXTimeFraction.
-                # XIncrement: The time between points in the acquired waveform in seconds.
-                # ScaleFactor: Scaling factor for the waveform data.
-                # ScaleOffset: Scaling offset for the waveform data.
-                VoltageArray1 = __ScaleOffset1 + np.multiply(__OutArray1[__FirstValidPoint1:__FirstValidPoint1+__ActualPoints1],__ScaleFactor1)
-                VoltageArray2 = __ScaleOffset2 + np.multiply(__OutArray2[__FirstValidPoint2:__FirstValidPoint2+__ActualPoints2],__ScaleFactor2)
-                
-                # averaging over records
-                OutVoltageArrays1j = (OutVoltageArrays1j*j + VoltageArray1)/(j+1)
-                OutVoltageArrays2j = (OutVoltageArrays2j*j + VoltageArray2)/(j+1)
-            self._instrument.dig.continue_acquisition() 
-            # averaging over acquisitions
-            OutVoltageArrays1i = (OutVoltageArrays1i*i + OutVoltageArrays1j)/(i+1)
-            OutVoltageArrays2i = (OutVoltageArrays2i*i + OutVoltageArrays2j)/(i+1)
-
-        if NoErrorCheck == True:
-            Time1 = np.linspace(__InitialXOffset1,__InitialXOffset1+__ActualPoints1*__XIncrement1,__ActualPoints1)
-            Time2 = np.linspace(__InitialXOffset2,__InitialXOffset2+__ActualPoints2*__XIncrement2,__ActualPoints2)
-            self._instrument.dig.stop() # stop acquisition
-            self._instrument.awg.ch1.abort_generation() # abort generation            
-            self._instrument.awg.ch2.abort_generation() # abort generation   
-        
-        print('get() of "IQArray_averaged" was executed in {0} s'.format(time()-start_time))
-        print('If running QCoDes Measure() or Loop() function: Waiting for QCoDes to write the data to a file.')
-        return OutVoltageArrays1i, OutVoltageArrays2i, Time1, Time2    
+        return self._instrument.measure(MeanTrace(), name='IQArray_averaged')[0]
 
 class SingleIQPair_averaged(MultiParameter):
     """
@@ -205,77 +228,116 @@ class SingleIQPair_averaged(MultiParameter):
         
     
     def get_raw(self):
-        self._instrument.dig.start()                  # Initiates a waveform acquisition. The digitizer waits for a trigger.
+        # average over the points of the averaged records
+        OutVoltageArray1, OutVoltageArray2, Time1, Time2 = self._instrument.measure(MeanTrace(), name='SingleIQPair_averaged')[0]
+        return np.mean(OutVoltageArray1), np.mean(OutVoltageArray2)
 
-        # initiate AWG generation
-        self._instrument.awg.initiate_generation('Channel1,Channel2')
+class IQWindows_averaged(MultiParameter):
+    """
+    MultiParameter class for gated integration of IQ data
+    Returns the averaged signal in every window of IntegrationWindows as an array of shape (n_windows, 2),
+    with Channel1 (I) in the first and Channel2 (Q) in the second column.
+    The windows are linear in the records, so they are applied once to the sum of all records.
+    """
+    def __init__(self, name, instrument, nacqs, nrcds, npts):
+        super().__init__(name,
+                         names=('IQ_windows',),
+                         shapes=((),),
+                         labels=('IQ_windows',),
+                         units=('V',))                        
+        
+        # Read instrument parameters
+        self._instrument = instrument
+        
+        self.setpoint_names = (('window','channel'),)
+        
+        # Set shapes
+        self.update_shapes(nacqs,nrcds,npts)
 
-        # update nacqs, nrcds and npts values
-        self.__nacqs = self._instrument.dig.NumberOfAcquisitions()
-        self.__nrcds = self._instrument.dig.NumRecordsPerAcquisition()
-        self.__npts = self._instrument.dig.RecordSize()
-             
-        OutVoltage1 = 0
-        OutVoltage2 = 0
-        
-        # fetch data
-        #print('Fetching data...')
-        #print('Number of Acquisitions: ', self.__nacqs)
-        #print('Number of Records Per Acquisition: ', self.__nrcds)
-        #print('**Number of Averages (= NumberOfAcquisitions x NumberOfRecordsPerAcquisition): ', self.__nacqs*self.__nrcds,'**')
-        start_time = time() # get time stamp
-        for i in range(self.__nacqs):
-            NoErrorCheck = self._instrument.dig.WaitUntilAcqComplete() # Indicates if a (single- or multi-record) waveform can be fetched from the instrument.
-            if NoErrorCheck == False: 
-                break
-            for j in range(self.__nrcds):
-                #print('data taken {0} s'.format(time()-start_time))
-                # This function returns the waveform the digitizer acquired for the specified channel in raw ADC units.
-                [__OutArray1, __ActualPoints1, __FirstValidPoint1, __InitialXOffset1, __InitialXTimeSeconds1, __InitialXTimeFraction1, __XIncrement1, __ScaleFactor1, __ScaleOffset1] = self._instrument.dig.AgMD2.Channels('Channel1').Measurement.FetchWaveformInt16()
-                [__OutArray2, __ActualPoints2, __FirstValidPoint2, __InitialXOffset2, __InitialXTimeSeconds2, __InitialXTimeFraction2, __XIncrement2, __ScaleFactor2, __ScaleOffset2] = self._instrument.dig.AgMD2.Channels('Channel2').Measurement.FetchWaveformInt16()
-                #print('data fetched {0} s'.format(time()-start_time))
-                ##############################
-                # Outputs:
-                # OutArray:  Buffer into which the acquired waveform is stored.
-                # ActualPoints: Indicates how many data points were actually retrieved from the instrument.
-                # FirstValidPoint: Indicates the index of the first valid data point in the output data array.
-                # InitialXOffset: The time in relation to the Trigger Event of the first point in the waveform in seconds. Negative values mean that the first point in the waveform array was acquired before the trigger event.
-                # InitialXTimeSeconds: Specifies the seconds portion of the absolute time at which the first data point was acquired. Note that the actual time is the sum of InitialXTimeSeconds and InitialXTimeFraction.
-                # InitialXTimeFraction: Specifies the fractional portion of the absolute time at which the first data point was acquired. Note that the actual time is the sum of InitialXTimeSeconds and InitialXTimeFraction.
-                # XIncrement: The time between points in the acquired waveform in seconds.
-                # ScaleFactor: Scaling factor for the waveform data.
-                # ScaleOffset: Scaling offset for the waveform data.
-                Voltage1 = __ScaleOffset1 + __ScaleFactor1*np.mean(__OutArray1[__FirstValidPoint1:__FirstValidPoint1+__ActualPoints1])
-                Voltage2 = __ScaleOffset2 + __ScaleFactor2*np.mean(__OutArray2[__FirstValidPoint2:__FirstValidPoint2+__ActualPoints2])
-                
-                #print('data scaled {0} s'.format(time()-start_time))
-                
-                # averaging
-                OutVoltage1 = (OutVoltage1*j + Voltage1)/(j+1)
-                OutVoltage2 = (OutVoltage2*j + Voltage2)/(j+1)
-                #print('data averaged {0} s'.format(time()-start_time))
-            self._instrument.dig.continue_acquisition() 
+    def update_shapes(self,nacqs,nrcds,npts):
+        self.shapes = ((len(self._instrument.IntegrationWindows()),2),)
+    
+    def get_raw(self):
+        return (self._instrument.measure(WindowIntegral(self._instrument.window_weights), name='IQWindows_averaged')[0],)
+
+class IQArray_histogram(MultiParameter):
+    """
+    MultiParameter class for single-shot readout
+    Every record is integrated over the first window of IntegrationWindows as soon as it is fetched and the (I, Q) pair
+    is binned into a 2D histogram of HistogramBins x HistogramBins bins over HistogramRange, so the memory does not depend
+    on the number of records. If StateThreshold is set, the records are discriminated into two states and their
+    fractions are returned, otherwise the state fractions are NaN.
+    """
+    def __init__(self, name, instrument, nacqs, nrcds, npts):
+        super().__init__(name,
+                         names=('IQ_counts','I_edges','Q_edges','state_fractions'),
+                         shapes=((), (), (), ()),
+                         labels=('IQ_counts','I_edges','Q_edges','state_fractions'),
+                         units=('', 'V','V',''))                        
+        
+        # Read instrument parameters
+        self._instrument = instrument
+        
+        self.setpoint_names = (('I_bin','Q_bin'), ('I_edge',), ('Q_edge',), ('state',))
+        
+        # Set shapes
+        self.update_shapes(nacqs,nrcds,npts)
 
-        if NoErrorCheck == True:
-            self._instrument.dig.stop() # stop acquisition
-            self._instrument.awg.ch1.abort_generation() # abort generation            
-            self._instrument.awg.ch2.abort_generation() # abort generation   
-        
-        #print('get() of "SingleIQPair_averaged" was executed in {0} s'.format(time()-start_time))
-        #print('If running QCoDes Measure() or Loop() function: Waiting for QCoDes to write the data to a file.')
-        return OutVoltage1, OutVoltage2   
+    def update_shapes(self,nacqs,nrcds,npts):
+        bins = self._instrument.HistogramBins()
+        self.shapes = ((bins,bins), (bins+1,), (bins+1,), (2,))
+    
+    def get_raw(self):
+        I_range, Q_range = self._instrument.HistogramRange()
+        Histogram = IQHistogram(lambda npts: self._instrument.window_weights(npts)[0], I_range, Q_range,
+                                bins=self._instrument.HistogramBins(), threshold=self._instrument.StateThreshold())
+        Counts, I_edges, Q_edges, Outliers, StateCounts = self._instrument.measure(Histogram, name='IQArray_histogram')[0]
+        if Outliers:
+            log.warning('%d records are outside of the HistogramRange', Outliers)
+        StateFractions = StateCounts/max(StateCounts.sum(), 1) if Histogram.threshold is not None else np.full(2, np.nan)
+        return Counts, I_edges, Q_edges, StateFractions
+
+class IQArray_spectrum(MultiParameter):
+    """
+    MultiParameter class for noise spectroscopy
+    Returns the Welch power spectral densities of both channels and their cross-spectral density,
+    accumulated over all records with segments of SpectrumSegmentLength points, instead of the raw records.
+    """
+    def __init__(self, name, instrument, nacqs, nrcds, npts):
+        super().__init__(name,
+                         names=('frequency','I_psd','Q_psd','IQ_csd'),
+                         shapes=((), (), (), ()),
+                         labels=('frequency','I_psd','Q_psd','IQ_csd'),
+                         units=('Hz', 'V^2/Hz','V^2/Hz','V^2/Hz'))                        
+        
+        # Read instrument parameters
+        self._instrument = instrument
+        
+        self.setpoint_names = (('frequency_index',), ('I_psd_frequency',), ('Q_psd_frequency',), ('IQ_csd_frequency',))
+        
+        # Set shapes
+        self.update_shapes(nacqs,nrcds,npts)
+
+    def update_shapes(self,nacqs,nrcds,npts):
+        nperseg = self._instrument.SpectrumSegmentLength()
+        nfreqs = (npts if nperseg is None else nperseg)//2 + 1
+        self.shapes = ((nfreqs,), (nfreqs,), (nfreqs,), (nfreqs,))
+    
+    def get_raw(self):
+        return self._instrument.measure(PowerSpectrum(self._instrument.SpectrumSegmentLength()), name='IQArray_spectrum')[0]
 
 class Zoidberg2(Instrument):
     """ 
     Driver for the Zoidberg2 using the Keysight M9336A and M9203A card.
-    
+    Parameters:
+        backend - 'real' for the vendor drivers, 'emulated' to run without hardware (see AgMD2Emulator and KtMAwgEmulator)
     """
-    def __init__(self, name, **kwargs):
+    def __init__(self, name, backend='real', **kwargs):
         super().__init__(name, **kwargs)
 
         print('Initializing AWG ({0}.awg) and digitizer ({1}.dig) ...'.format(name,name))        
-        self.awg = M9336A('awg', 'PXI19::0::0::INSTR')
-        self.dig = M9203A('dig', 'PXI20::0::0::INSTR')
+        self.awg = M9336A('awg', 'PXI19::0::0::INSTR', backend=backend)
+        self.dig = M9203A('dig', 'PXI20::0::0::INSTR', backend=backend)
         
         # For digitizer acquisition config
         self.__NumRecordsPerAcquisition = self.dig.NumRecordsPerAcquisition()      # Specifies the number of records in the acquisition.
@@ -284,6 +346,26 @@ class Zoidberg2(Instrument):
 
         self.__Pi = 180
         self.__Delay1 = 30000
+        
+        # For gated integration: list of (start, stop) or (start, stop, weights) sample-index windows, stop=None is the end of the record
+        self.__IntegrationWindows = [(0, None)]
+        
+        # For single-shot histograms: ((I min, I max), (Q min, Q max)) in V, bins per axis and (angle, level) of the discriminator
+        self.__HistogramRange = ((-1.0, 1.0), (-1.0, 1.0))
+        self.__HistogramBins = 100
+        self.__StateThreshold = None
+        
+        # For noise spectra: points per Welch segment, None for whole records
+        self.__SpectrumSegmentLength = None
+        
+        # For the async API: one worker thread runs all blocking driver calls, so they never overlap
+        self.__Executor = None
+        self.__Cancel = threading.Event()   # set by stop_acquisition() and by cancelling an async call, cleared when an acquisition is armed
+        
+        # For digital down-conversion
+        self.__DemodulationFrequency = 0.0      # intermediate frequency in Hz
+        self.__DecimationFactor = 1             # number of samples averaged into one baseband sample
+        self.ddc = DigitalDownConverter(self.__DemodulationFrequency, self.__DecimationFactor)
 
         self.add_parameter(name = 'NumRecordsPerAcquisition',   # Specifies the number of records in the acquisition.
                           label = 'Number of Records',
@@ -305,12 +387,76 @@ class Zoidberg2(Instrument):
                            get_cmd = self.get_NumberOfAcquisitions,
                            vals = vals.Ints(0,BIGINT))
         
+        self.add_parameter(name='DemodulationFrequency',
+                           label = 'Intermediate frequency of the digital down-conversion',
+                           unit='Hz',
+                           set_cmd = self.set_DemodulationFrequency,
+                           get_cmd = self.get_DemodulationFrequency,
+                           vals = vals.Numbers())
+        
+        self.add_parameter(name='DecimationFactor',
+                           label = 'Decimation factor of the digital down-conversion',
+                           unit='',
+                           set_cmd = self.set_DecimationFactor,
+                           get_cmd = self.get_DecimationFactor,
+                           vals = vals.Ints(1,BIGINT))
+        
+        self.add_parameter(name='IntegrationWindows',
+                           label = 'Windows of the gated integration',
+                           set_cmd = self.set_IntegrationWindows,
+                           get_cmd = self.get_IntegrationWindows,
+                           vals = vals.Anything())
+        
+        self.add_parameter(name='HistogramRange',
+                           label = 'I and Q range of the single-shot histogram',
+                           unit='V',
+                           set_cmd = self.set_HistogramRange,
+                           get_cmd = self.get_HistogramRange,
+                           vals = vals.Anything())
+        
+        self.add_parameter(name='HistogramBins',
+                           label = 'Bins per axis of the single-shot histogram',
+                           unit='',
+                           set_cmd = self.set_HistogramBins,
+                           get_cmd = self.get_HistogramBins,
+                           vals = vals.Ints(1,4096))
+        
+        self.add_parameter(name='StateThreshold',
+                           label = 'Discriminator (angle, level) of the single-shot states',
+                           set_cmd = self.set_StateThreshold,
+                           get_cmd = self.get_StateThreshold,
+                           vals = vals.Anything())
+        
+        self.add_parameter(name='SpectrumSegmentLength',
+                           label = 'Points per segment of the Welch power spectrum',
+                           unit='pts',
+                           set_cmd = self.set_SpectrumSegmentLength,
+                           get_cmd = self.get_SpectrumSegmentLength,
+                           vals = vals.MultiType(vals.Ints(2,BIGINT), vals.Enum(None)))
+        
+        self.add_parameter(name='StageStatistics',
+                           label = 'Acquisition stage timing statistics',
+                           get_cmd = self.dig.get_StageStatistics,
+                           set_cmd = False)
+        
         self.add_parameter(name='IQ_data_raw',
                            nacqs=self.NumberOfAcquisitions(),
                            nrcds=self.NumRecordsPerAcquisition(),
                            npts=self.RecordSize(),
                            parameter_class=IQArray_raw)
         
+        self.add_parameter(name='IQ_data_raw_int16',
+                           nacqs=self.NumberOfAcquisitions(),
+                           nrcds=self.NumRecordsPerAcquisition(),
+                           npts=self.RecordSize(),
+                           parameter_class=IQArray_raw_int16)
+        
+        self.add_parameter(name='IQ_data_demodulated',
+                           nacqs=self.NumberOfAcquisitions(),
+                           nrcds=self.NumRecordsPerAcquisition(),
+                           npts=self.RecordSize(),
+                           parameter_class=IQArray_demodulated)
+        
         self.add_parameter(name='IQ_data_averaged',
                            nacqs=self.NumberOfAcquisitions(),
                            nrcds=self.NumRecordsPerAcquisition(),
@@ -323,6 +469,24 @@ class Zoidberg2(Instrument):
                            npts=self.RecordSize(),
                            parameter_class=SingleIQPair_averaged)
         
+        self.add_parameter(name='IQ_data_windows',
+                           nacqs=self.NumberOfAcquisitions(),
+                           nrcds=self.NumRecordsPerAcquisition(),
+                           npts=self.RecordSize(),
+                           parameter_class=IQWindows_averaged)
+        
+        self.add_parameter(name='IQ_data_histogram',
+                           nacqs=self.NumberOfAcquisitions(),
+                           nrcds=self.NumRecordsPerAcquisition(),
+                           npts=self.RecordSize(),
+                           parameter_class=IQArray_histogram)
+        
+        self.add_parameter(name='IQ_data_spectrum',
+                           nacqs=self.NumberOfAcquisitions(),
+                           nrcds=self.NumRecordsPerAcquisition(),
+                           npts=self.RecordSize(),
+                           parameter_class=IQArray_spectrum)
+        
         self.add_parameter(name='Pi',
                            label= 'Length of Pi pulse',
                            set_cmd = self.set_Pi,
@@ -345,6 +509,91 @@ class Zoidberg2(Instrument):
     def get_Delay1(self):
         return self.__Delay1       
     
+    def set_DemodulationFrequency(self,value):
+        self.__DemodulationFrequency = value
+        self.ddc = DigitalDownConverter(self.__DemodulationFrequency, self.__DecimationFactor)
+        
+    def get_DemodulationFrequency(self):
+        return self.__DemodulationFrequency
+    
+    def set_DecimationFactor(self,value):
+        self.__DecimationFactor = value
+        self.ddc = DigitalDownConverter(self.__DemodulationFrequency, self.__DecimationFactor)
+        self._update_IQArray_shapes()
+        
+    def get_DecimationFactor(self):
+        return self.__DecimationFactor
+    
+    def set_IntegrationWindows(self,value):
+        windows = []
+        for window in value:
+            if len(window) not in (2, 3):
+                raise ValueError('Integration windows must be (start, stop) or (start, stop, weights)')
+            start, stop = window[0], window[1]
+            if start < 0 or (stop is not None and stop <= start):
+                raise ValueError('Integration window {0} is empty'.format((start, stop)))
+            if len(window) == 3:
+                weights = np.asarray(window[2], dtype=np.float64)
+                if weights.ndim > 0 and stop is not None and len(weights) != stop - start:
+                    raise ValueError('Integration window {0} has {1} weights for {2} points'.format((start, stop), len(weights), stop - start))
+                if not np.any(weights) or not np.all(np.isfinite(weights)):
+                    raise ValueError('The weights of integration window {0} must be finite and not all zero'.format((start, stop)))
+            windows.append(tuple(window))
+        self.__IntegrationWindows = windows
+        self._update_IQArray_shapes()
+        
+    def get_IntegrationWindows(self):
+        return self.__IntegrationWindows
+    
+    def window_weights(self, npts):
+        """
+        Returns the weights of all integration windows as an array of shape (n_windows, npts).
+        Each row is normalized by the sum of the absolute weights, so uniform weights give the mean voltage in the window.
+        """
+        Weights = np.zeros((len(self.__IntegrationWindows), npts))
+        for k, window in enumerate(self.__IntegrationWindows):
+            start, stop = window[0], (npts if window[1] is None else window[1])
+            if not 0 <= start < stop <= npts:
+                raise ValueError('Integration window {0} is outside of the record of {1} points'.format(window[:2], npts))
+            Weights[k, start:stop] = window[2] if len(window) == 3 else 1.0
+            norm = np.sum(np.abs(Weights[k]))
+            if norm == 0:
+                raise ValueError('The weights of integration window {0} are all zero'.format(window[:2]))
+            Weights[k] /= norm
+        return Weights
+    
+    def set_HistogramRange(self,value):
+        (Imin, Imax), (Qmin, Qmax) = value
+        if not (Imin < Imax and Qmin < Qmax):
+            raise ValueError('HistogramRange must be ((I min, I max), (Q min, Q max)) with min < max')
+        self.__HistogramRange = ((Imin, Imax), (Qmin, Qmax))
+        
+    def get_HistogramRange(self):
+        return self.__HistogramRange
+    
+    def set_HistogramBins(self,value):
+        self.__HistogramBins = value
+        self._update_IQArray_shapes()
+        
+    def get_HistogramBins(self):
+        return self.__HistogramBins
+    
+    def set_StateThreshold(self,value):
+        if value is not None:
+            angle, level = value
+            value = (float(angle), float(level))
+        self.__StateThreshold = value
+        
+    def get_StateThreshold(self):
+        return self.__StateThreshold
+    
+    def set_SpectrumSegmentLength(self,value):
+        self.__SpectrumSegmentLength = value
+        self._update_IQArray_shapes()
+        
+    def get_SpectrumSegmentLength(self):
+        return self.__SpectrumSegmentLength
+    
     def set_NumberOfAcquisitions(self,value):
         self.__NumberOfAcquisitions = value
         self.dig.NumberOfAcquisitions(value)
@@ -374,7 +623,7 @@ class Zoidberg2(Instrument):
         nrcds = self.NumRecordsPerAcquisition()
         npts = self.RecordSize()
         for _, parameter in self.parameters.items():
-            if isinstance(parameter, (IQArray_raw,IQArray_averaged)):
+            if isinstance(parameter, (IQArray_raw,IQArray_raw_int16,IQArray_demodulated,IQArray_averaged,IQWindows_averaged,IQArray_histogram,IQArray_spectrum)):
                 try:
                     parameter.update_shapes(nacqs,nrcds,npts)
                 except AttributeError:
@@ -382,8 +631,191 @@ class Zoidberg2(Instrument):
                 
     def get_RecordSize(self):
         return self.__RecordSize
+    
+    def start_acquisition(self):
+        """ arms the digitizer and initiates the AWG generation, timed as the arm stage """
+        self.__Cancel.clear()
+        with self.dig.timer.stage('arm'):
+            self.dig.start()     # Initiates a waveform acquisition. The digitizer waits for a trigger.
+            self.awg.initiate_generation('Channel1,Channel2')
+    
+    def stop_acquisition(self):
+        """ stops the acquisition and aborts the AWG generation, timed as the abort stage """
+        self.__Cancel.set()     # ends a wait for the stopped acquisition
+        with self.dig.timer.stage('abort'):
+            self.dig.stop()
+            self.awg.ch1.abort_generation()
+            self.awg.ch2.abort_generation()
+    
+    def reset_StageStatistics(self):
+        self.dig.reset_StageStatistics()
+    
+    def measure(self, *reducers, name='measure'):
+        """
+        Runs one acquisition with the AWG generating and feeds every fetched acquisition to all reducers,
+        so several results are obtained from a single hardware run, e.g. the averaged trace and the window integrals:
+            trace = MeanTrace()
+            (I, Q, TimeI, TimeQ), IQ = zoidberg.measure(trace, WindowIntegral(zoidberg.window_weights, trace))
+        See M9203A.measure.
+        Returns:
+            list with the result of every reducer
+        """
+        # cancelling an async call sets __Cancel and stops the measurement after the current acquisition
+        return self.dig.measure(*reducers, start=self.start_acquisition, stop=self.stop_acquisition, stop_event=self.__Cancel, name=name)
+    
+    def _executor(self):
+        if self.__Executor is None:
+            # the worker thread calls the digitizer through its own marshaled driver proxy, as the fetch thread does
+            self.__Executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='{0}_async'.format(self.name),
+                                                 initializer=self.dig.init_fetch_thread)
+        return self.__Executor
+    
+    async def _run_async(self, function, stop_on_cancel=False):
+        """
+        Runs a blocking function in the executor. Cancelling the task sets the event __Cancel,
+        which ends a running measurement (the measurement stops the acquisition itself) or wait.
+        Parameters:
+            function - function without arguments
+            stop_on_cancel - also stop the acquisition and abort the AWG generation when the task is cancelled
+        """
+        future = self._executor().submit(function)
+        try:
+            return await asyncio.shield(asyncio.wrap_future(future))
+        except asyncio.CancelledError:
+            if future.cancel():     # did not start yet
+                raise
+            self.__Cancel.set()
+            try:
+                await asyncio.wrap_future(future)   # ends after the current acquisition
+            except Exception:
+                pass
+            if stop_on_cancel:
+                await asyncio.wrap_future(self._executor().submit(self.stop_acquisition))
+                log.info('%s: wait or fetch cancelled, digitizer stopped and AWG generation aborted', self.name)
+            raise
+    
+    async def start_acquisition_async(self):
+        """ awaitable start_acquisition() """
+        await self._run_async(self.start_acquisition)
+    
+    async def wait_acquisition_async(self):
+        """
+        Awaits the completion of the next acquisition, returns False after a timeout or memory overflow.
+        If the task is cancelled, the digitizer is stopped and the AWG generation is aborted.
+        """
+        return await self._run_async(lambda: self.dig.WaitUntilAcqComplete(self.__Cancel), stop_on_cancel=True)
+    
+    async def fetch_async(self, Block=None):
+        """
+        Awaitable fetch of the completed acquisition, e.g. after wait_acquisition_async(), see M9203A.fetch_acquisition.
+        If the task is cancelled, the digitizer is stopped and the AWG generation is aborted.
+        Parameters:
+            Block - AcquisitionBlock into which the records are fetched, None for a new one
+        Returns:
+            the filled AcquisitionBlock
+        """
+        return await self._run_async(lambda: self.dig.fetch_acquisition(Block), stop_on_cancel=True)
+    
+    async def stop_acquisition_async(self):
+        """ awaitable stop_acquisition() """
+        await self._run_async(self.stop_acquisition)
+    
+    async def measure_async(self, *reducers, name='measure'):
+        """
+        Awaitable measure(), the acquisition runs in a worker thread while the event loop serves other instruments.
+        If the task is cancelled, the measurement ends after the current acquisition, the digitizer is stopped
+        and the AWG generation is aborted before CancelledError is raised.
+        """
+        return await self._run_async(lambda: self.measure(*reducers, name=name))
+    
+    async def get_async(self, parameter):
+        """
+        Awaitable get() of a parameter, e.g. await zoidberg.get_async('IQ_data_averaged').
+        Acquisition parameters are cancelled like measure_async().
+        """
+        if isinstance(parameter, str):
+            parameter = self.parameters[parameter]
+        return await self._run_async(parameter.get)
+    
+    @contextmanager
+    def acquisition_config(self):
+        """
+        Collects the changes of NumRecordsPerAcquisition and RecordSize and sends them to the digitizer
+        with a single ConfigureAcquisition call when the block is left, see M9203A.acquisition_config.
+        """
+        try:
+            with self.dig.acquisition_config():
+                yield self
+        finally:
+            # the digitizer holds the committed configuration, also if the block raised
+            self.__NumRecordsPerAcquisition = self.dig.NumRecordsPerAcquisition()
+            self.__RecordSize = self.dig.RecordSize()
+            self._update_IQArray_shapes()
+    
+    def load_waveforms(self, waveforms):
+        """
+        Uploads and configures the waveforms of one point of a pulse sequence.
+        Parameters:
+            waveforms - dict {channel name: (WaveformArray, MarkerArray)}, e.g. {'ch1': (waveform, markersArray), 'ch2': (waveform, [])}
+        """
+        for ch_name, (WaveformArray, MarkerArray) in waveforms.items():
+            channel = getattr(self.awg, ch_name)
+            channel.load_waveform('', WaveformArray, MarkerArray)
+            channel.init_channel()
+    
+    def sweep(self, parameter, values, build_waveforms, measure=None):
+        """
+        Sweeps a parameter of the pulse sequence (e.g. Pi or Delay1) and measures every point.
+        The waveforms of point N+1 are rendered in a background thread while point N is acquired,
+        so only the upload of the ready waveforms is left between two points.
+        Parameters:
+            parameter - name of the swept parameter of Zoidberg2
+            values - list of values of the parameter
+            build_waveforms - function(value) which returns the waveforms of one point as a dict
+                              {channel name: (WaveformArray, MarkerArray)}, e.g. built with WaveformGenerator.
+                              It runs in the background thread and must not access the instruments.
+            measure - parameter which is measured at every point, default IQ_data_averaged
+        Returns:
+            results - the measured values stacked along a new first axis (one array per name of a MultiParameter)
+            latency - setup time in s between the end of one point and the start of the next one
+        """
+        if measure is None:
+            measure = self.IQ_data_averaged
+        values = list(values)
+        results = []
+        latency = np.zeros(len(values))
+        
+        start_time = time()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(build_waveforms, values[0]) if values else None
+            for i, value in enumerate(values):
+                setup_time = time()
+                waveforms = future.result()     # waits only if rendering is slower than the previous acquisition
+                # render the next point while this one is acquired
+                future = executor.submit(build_waveforms, values[i+1]) if i+1 < len(values) else None
+                self.parameters[parameter](value)
+                self.load_waveforms(waveforms)
+                latency[i] = time() - setup_time
+                try:
+                    results.append(measure())
+                except BaseException:
+                    if future is not None:
+                        future.cancel()
+                    raise
+        
+        log.info('sweep of %s over %d points was executed in %.6f s, mean setup latency %.6f s', parameter, len(values), time() - start_time, np.mean(latency) if len(values) else 0.0)
+        
+        if results and isinstance(results[0], (tuple, list)):
+            results = tuple(np.stack(result) for result in zip(*results))
+        else:
+            results = np.stack(results) if results else np.array([])
+        return results, latency
         
     def disconnect(self):
+        if self.__Executor is not None:
+            self.__Executor.submit(self.dig.exit_fetch_thread).result()    # releases the driver proxy of the worker thread
+            self.__Executor.shutdown()
+            self.__Executor = None
         self.awg.disconnect()
         self.awg.close()
         self.dig.disconnect()